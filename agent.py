@@ -1,24 +1,108 @@
-from google.adk import Agent
-from google.adk.runners import Runner
-from google.adk.sessions.in_memory_session_service import InMemorySessionService
-from google.genai import types
-from tools import list_components, generate_drawio_xml
-import sys
+# google.adk, google.genai and dotenv are imported where they are first needed:
+# they take far longer to import than everything else, and cache hits, the
+# service's /generate route and plain tool users never touch them.
+import tools
+from tools import list_components, get_library_store
+from response_cache import ResponseCache, cache_key, CACHE_PATH, MAX_ENTRIES
+import tracing
+import argparse
+import asyncio
+import json
+import time
 import uuid
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
 
+DEFAULT_MODEL = "gemini-flash-latest"
 
-# Define the Agent
-def create_agent():
-    # Initialize agent with available tools
-    agent = Agent(
-        name="DrawIOArchitect",
-        model="gemini-flash-latest", # Updated to user requested model
-        tools=[list_components, generate_drawio_xml],
-        instruction="""
+# Canned tool call replayed by stub_llm()
+STUB_SPEC = {
+    "filename_prefix": "stub_system",
+    "components": [
+        {"id": "nodes-1", "library_id": "MUqYMd9_9H_2uWHAdu_l-4", "x": 300, "y": 50, "width": 800, "height": 600, "label": ""},
+        {"id": "nodes-2", "library_id": "MUqYMd9_9H_2uWHAdu_l-11", "x": 550, "y": 50, "label": "Stub System"},
+        {"id": "nodes-3", "library_id": "MUqYMd9_9H_2uWHAdu_l-3", "x": 50, "y": 350, "label": "User"},
+        {"id": "nodes-4", "library_id": "dv7I9-Y2neh1ySf-e8qv-1", "x": 400, "y": 350, "label": "stub-web-client\n[container:node.js]"},
+        {"id": "nodes-5", "library_id": "dv7I9-Y2neh1ySf-e8qv-1", "x": 700, "y": 350, "label": "api-stub-service\n[container:python]"},
+    ],
+    "edges": [
+        {"source": "nodes-3", "target": "nodes-4", "label": "Uses"},
+        {"source": "nodes-4", "target": "nodes-5", "label": "API Calls"},
+    ],
+}
+
+_stub_llm_class = None
+
+def stub_llm(latency=0.0):
+    """
+    Offline stand-in for Gemini. The first turn calls generate_drawio_xml with
+    STUB_SPEC, the turn after the tool response answers with a short text.
+    `latency` seconds are slept per turn to mimic model round-trips.
+    """
+    global _stub_llm_class
+    if _stub_llm_class is None:
+        from google.adk.models import BaseLlm, LlmResponse
+        from google.genai import types
+
+        class StubLlm(BaseLlm):
+            model: str = "stub"
+            latency: float = 0.0
+
+            async def generate_content_async(self, llm_request, stream=False):
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                last = llm_request.contents[-1] if llm_request.contents else None
+                if last and any(part.function_response for part in (last.parts or [])):
+                    yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text="Diagram generated.")]))
+                    return
+                call = types.FunctionCall(name="generate_drawio_xml", args=STUB_SPEC)
+                yield LlmResponse(content=types.Content(role="model", parts=[types.Part(function_call=call)]))
+
+        _stub_llm_class = StubLlm
+    return _stub_llm_class(latency=latency)
+
+def generate_drawio_xml(components, edges, filename_prefix="system_architecture", pages=None):
+    """
+    Generates a draw.io diagram from library components and edges and saves it
+    as architectures/[filename_prefix]_v[n].drawio. Returns a summary: the saved
+    path, vertex and edge counts, layout issues, and errors, one entry per
+    component or edge that was skipped and why.
+    """
+    # The agent's tool: tools.generate_drawio_xml's summary form, so the model
+    # learns which items were dropped instead of receiving the XML
+    return tools.generate_drawio_xml(components, edges, filename_prefix, stream=True, pages=pages)
+
+# Open spans of the model turns and tool calls in flight, keyed by invocation / call id
+_model_spans = {}
+_tool_spans = {}
+
+def _before_model(callback_context, llm_request):
+    if tracing.enabled():
+        _model_spans[callback_context.invocation_id] = tracing.start_span(
+            "model.turn", agent=callback_context.agent_name, contents=len(llm_request.contents or []))
+    return None
+
+def _after_model(callback_context, llm_response):
+    sp = _model_spans.pop(callback_context.invocation_id, None)
+    if sp is not None:
+        parts = llm_response.content.parts if llm_response.content else []
+        sp.end(text_chars=sum(len(p.text or "") for p in parts or []),
+               function_calls=sum(1 for p in parts or [] if p.function_call))
+    return None
+
+def _before_tool(tool, args, tool_context):
+    if tracing.enabled():
+        _tool_spans[tool_context.function_call_id] = tracing.start_span(
+            "tool.call", tool=tool.name, args_bytes=len(json.dumps(args, default=str)))
+    return None
+
+def _after_tool(tool, args, tool_context, tool_response):
+    sp = _tool_spans.pop(tool_context.function_call_id, None)
+    if sp is not None:
+        sp.end(response_bytes=len(json.dumps(tool_response, default=str)))
+    return None
+
+INSTRUCTION = """
         You are an expert solution architect and diagram designer. 
         Your goal is to help users design system architectures using a predefined library of components.
         
@@ -39,6 +123,7 @@ def create_agent():
                 -   **Databases**: `\n[Oracle]`, `\n[Postgresql]`, `\n[Redis]`, etc.
 
         2.  **Explore the Library**: Use `list_components` to see available shapes.
+            -   Call it with `compact=True` (ids and short labels only) and narrow it with `category` (container, database, queue, actor, boundary, title) or `query`; use `offset`/`limit` to page.
             -   **Standard (White)**: 'planner-web-client', 'api-planner-biz' (Default style).
             -   **New Services (Blue Tone)**: 'api-traffic-analyze' (ID: `dv7I9-Y2neh1ySf-e8qv-1`) has a **Colored** style.
             -   **Infrastructure**:
@@ -50,6 +135,9 @@ def create_agent():
                 -   **Storage/Logs**: Use `node-943...` (Cylinder, No Fill) for "DB", "Log", "Audit", "Warehouse".
         
         3.  **Layout Strategy (Crucial)**:
+            -   **Automatic Layout**: If you leave out `x` and `y` on every component, the tool lays the diagram out itself
+                (boundary, title, actors on the left, `'external': True` components on the right, DBs below their service).
+                Prefer this for large systems; the manual rules below apply when you place components yourself.
             -   **Step 1: The System Boundary**:
                 -   You **MUST** start by creating the 'System Boundary' component (`library_id='MUqYMd9_9H_2uWHAdu_l-4'`).
                 -   **Coordinates**: x=300, y=50.
@@ -81,7 +169,9 @@ def create_agent():
                - `components`: The list of all components. **MUST BE A LIST OF DICTIONARIES**, NOT STRINGS.
                - `edges`: The list of all edges.
                - `filename_prefix`: The snake_case version of the System Title (e.g., 'Todo System' -> 'todo_system').
+               - `pages` (optional, only for very large landscapes): extra pages as `[{'name': 'Data Flow', 'components': [...], 'edges': [...]}]`. Ids only need to be unique within a page.
             -   This will automatically save to `architectures/[prefix]_v[n].drawio`.
+            -   It returns a summary; if its `errors` list is not empty, those components or edges were skipped: fix them and call it again.
             -  **ORDER MATTERS**: The 'System Boundary' must be the **first** element in the list.
             -  Each component needs: `id`, `library_id`, `x`, `y`, and `label`.
             
@@ -117,27 +207,197 @@ def create_agent():
             
         Produce valid XML output that the user can save as a .drawio file.
         """
+
+# Define the Agent
+def create_agent(model=DEFAULT_MODEL):
+    from dotenv import load_dotenv
+    from google.adk import Agent
+    load_dotenv()
+    # Initialize agent with available tools
+    agent = Agent(
+        name="DrawIOArchitect",
+        model=model, # A model name, or a BaseLlm instance such as stub_llm()
+        tools=[list_components, generate_drawio_xml],
+        before_model_callback=_before_model,
+        after_model_callback=_after_model,
+        before_tool_callback=_before_tool,
+        after_tool_callback=_after_tool,
+        instruction=INSTRUCTION,
     )
     return agent
 
-def main():
-    agent = create_agent()
-    
-    if len(sys.argv) > 1:
-        user_input = sys.argv[1]
-    else:
-        print("Please provide a prompt argument.")
-        return
-
-    # Setup Runner
+def create_runner(agent):
+    from google.adk.runners import Runner
+    from google.adk.sessions.in_memory_session_service import InMemorySessionService
     session_service = InMemorySessionService()
-    runner = Runner(
+    return Runner(
         agent=agent,
         app_name="drawio-agent-demo",
         session_service=session_service,
         auto_create_session=True
     )
-    
+
+SPEC_KEYS = ("components", "edges", "filename_prefix", "pages")
+
+def tool_spec(function_call):
+    """The generate_drawio_xml arguments of a function call, or None for other tools."""
+    if function_call.name != "generate_drawio_xml":
+        return None
+    args = dict(function_call.args or {})
+    return {key: args[key] for key in SPEC_KEYS if key in args}
+
+def prompt_cache_key(model, prompt):
+    """Cache key of a prompt for a model name or BaseLlm; needs no agent, so a hit never imports ADK."""
+    model_name = model if isinstance(model, str) else getattr(model, "model", "")
+    return cache_key(prompt, INSTRUCTION, get_library_store().digest(), model_name)
+
+def replay_cached(cache, entry):
+    """Regenerates a cached spec without the model. Returns (summary, seconds)."""
+    started = time.perf_counter()
+    with tracing.span("cache.replay"):
+        summary = generate_drawio_xml(**entry["spec"])
+    seconds = time.perf_counter() - started
+    cache.record_saved(entry["seconds"] - seconds)
+    return summary, seconds
+
+async def run_prompt(runner, prompt, user_id="test-user", cache=None):
+    """
+    Runs one prompt to completion and returns a result record (never raises).
+    With a ResponseCache, a hit replays the stored spec instead of calling the
+    model, and a successful run stores the spec of its last generate_drawio_xml call.
+    """
+    with tracing.span("agent.run", prompt_chars=len(prompt)) as sp:
+        result = await _run_prompt(runner, prompt, user_id, cache)
+        sp.set(cached=result["cached"], tool_calls=len(result["tool_calls"]), error=result["error"])
+    return result
+
+async def _run_prompt(runner, prompt, user_id, cache):
+    session_id = str(uuid.uuid4())
+    started = time.perf_counter()
+    result = {"prompt": prompt, "session_id": session_id, "text": "", "tool_calls": [], "seconds": 0.0, "error": None, "cached": False}
+    key = None
+    if cache is not None:
+        key = prompt_cache_key(runner.agent.model, prompt)
+        entry = cache.get(key)
+        if entry is not None:
+            try:
+                summary, seconds = await asyncio.to_thread(replay_cached, cache, entry)
+                result.update(cached=True, tool_calls=["generate_drawio_xml"], path=summary["path"],
+                              text=f"Replayed cached diagram to {summary['path']}")
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["seconds"] = round(time.perf_counter() - started, 6)
+            return result
+    from google.genai import types
+    texts = []
+    spec = None
+    try:
+        async for event in runner.run_async(
+            user_id=user_id,
+            session_id=session_id,
+            new_message=types.Content(role="user", parts=[types.Part(text=prompt)])
+        ):
+            if not event.content:
+                continue
+            for part in event.content.parts or []:
+                if part.text:
+                    texts.append(part.text)
+                if part.function_call:
+                    result["tool_calls"].append(part.function_call.name)
+                    spec = tool_spec(part.function_call) or spec
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["text"] = "".join(texts)
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    if cache is not None and spec and not result["error"]:
+        cache.put(key, spec, result["seconds"])
+    return result
+
+async def run_batch(prompts, output_path, concurrency=4, model=DEFAULT_MODEL, cache=None):
+    """
+    Runs many prompts through one shared Runner with at most `concurrency` in
+    flight. Results are appended to `output_path` as JSONL as they complete,
+    each tagged with the prompt's input index.
+    """
+    runner = create_runner(create_agent(model))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(index, prompt):
+        async with semaphore:
+            result = await run_prompt(runner, prompt, cache=cache)
+        result["index"] = index
+        return result
+
+    started = time.perf_counter()
+    done = failed = 0
+    with open(output_path, 'w', encoding='utf-8') as out:
+        for next_done in asyncio.as_completed([bounded(i, p) for i, p in enumerate(prompts)]):
+            result = await next_done
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            done += 1
+            failed += bool(result["error"])
+    elapsed = time.perf_counter() - started
+    print(f"Ran {done} prompts in {elapsed:.2f}s with concurrency {concurrency} ({failed} failed)")
+    if cache is not None:
+        cache.save()
+        cache.report()
+
+def read_prompts(path):
+    """One prompt per line; JSON lines are read from their 'prompt' key."""
+    prompts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            prompts.append(json.loads(line)["prompt"] if line.startswith("{") else line)
+    return prompts
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates draw.io architectures from prompts.")
+    parser.add_argument('prompt', nargs='?', help="single prompt to run")
+    parser.add_argument('--batch', metavar='FILE', help="run every prompt in FILE concurrently")
+    parser.add_argument('--output', default='batch_results.jsonl', help="batch results (JSONL)")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--stub', action='store_true', help="use the offline stub model instead of Gemini")
+    parser.add_argument('--stub-latency', type=float, default=0.0)
+    parser.add_argument('--no-cache', action='store_true', help="always call the model")
+    parser.add_argument('--cache-path', default=CACHE_PATH)
+    parser.add_argument('--cache-size', type=int, default=MAX_ENTRIES, help="max cached prompts (LRU)")
+    parser.add_argument('--trace', metavar='FILE', help="append timing spans to FILE as JSONL")
+    parser.add_argument('--debug', action='store_true', help="print debug dumps of tool input and events")
+    args = parser.parse_args()
+
+    if args.trace:
+        tracing.configure(path=args.trace)
+    if args.debug:
+        tracing.set_debug(True)
+
+    model = stub_llm(args.stub_latency) if args.stub else DEFAULT_MODEL
+    cache = None if args.no_cache else ResponseCache(args.cache_path, args.cache_size)
+    if args.batch:
+        asyncio.run(run_batch(read_prompts(args.batch), args.output, args.concurrency, model, cache))
+        return
+
+    if not args.prompt:
+        print("Please provide a prompt argument.")
+        return
+    user_input = args.prompt
+
+    key = None
+    if cache is not None:
+        key = prompt_cache_key(model, user_input)
+        entry = cache.get(key)
+        if entry is not None:
+            summary, _ = replay_cached(cache, entry)
+            print(f"Replayed cached diagram to {summary['path']}")
+            cache.save()
+            cache.report()
+            return
+    from google.genai import types
+    runner = create_runner(create_agent(model))
+
     user_id = "test-user"
     session_id = str(uuid.uuid4())
     
@@ -151,12 +411,18 @@ def main():
     )
     
     # Process events
+    started = time.perf_counter()
+    spec = None
     for event in events:
         if event.content:
             for part in event.content.parts:
-                print(f"DEBUG Part: {part}")
+                tracing.debug(lambda: f"Part: {part}")
                 if part.text:
                     print(part.text)
+                if part.function_call:
+                    spec = tool_spec(part.function_call) or spec
+    if cache is not None and spec:
+        cache.put(key, spec, time.perf_counter() - started)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,264 @@
+"""
+Offline benchmarks for generation, library access and extraction.
+
+    python bench.py                      # all cases, sizes 10 .. 100k
+    python bench.py --quick              # sizes up to 10k
+    python bench.py --save-baseline      # store results as the new baseline
+    python bench.py --only generate      # one case family
+
+Every case runs on synthetic data in a temporary directory and reports the best
+wall time over --repeat runs, throughput and peak traced memory. Results are
+compared with bench_baseline.json; cases slower than the baseline by more than
+--threshold are flagged and make the run exit with status 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import extractor
+import tools
+
+BASELINE_PATH = 'bench_baseline.json'
+SIZES = [10, 100, 1000, 10000, 100000]
+QUICK_SIZES = [10, 100, 1000, 10000]
+CORPUS_FILES = [10, 100, 1000]
+QUICK_CORPUS_FILES = [10, 100]
+NODES_PER_SAMPLE = 50
+GRID_SPACING = 200
+
+# Styles of the shapes found in the real library, one per category
+STYLES = [
+    "rounded=0;whiteSpace=wrap;html=1;",
+    "rounded=0;whiteSpace=wrap;html=1;fillColor=light-dark(#FFFFFF,#9999FF);",
+    "shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;backgroundOutline=1;size=15;",
+    "shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;backgroundOutline=1;size=15;direction=south;fillColor=none",
+    "shape=umlActor;verticalLabelPosition=bottom;verticalAlign=top;html=1;outlineConnect=0;",
+]
+
+def synthetic_library(size, rng):
+    return [{
+        "id": f"lib-{i}",
+        "value": f"component-{i}<div>[container:python]</div>",
+        "style": STYLES[i % len(STYLES)],
+        "width": 120.0,
+        "height": 60.0,
+        "x": 0.0,
+        "y": 0.0,
+    } for i in range(size)]
+
+def synthetic_graph(nodes, library_ids, rng, positioned=True):
+    """
+    Components on a square grid with edges to right and lower neighbours (about
+    one edge per node), which is how generated architectures are shaped.
+    """
+    columns = max(1, int(math.sqrt(nodes)))
+    components = []
+    for i in range(nodes):
+        comp = {"id": f"n{i}", "library_id": library_ids[i % len(library_ids)], "label": f"service-{i}"}
+        if positioned:
+            comp["x"] = (i % columns) * GRID_SPACING
+            comp["y"] = (i // columns) * GRID_SPACING
+        components.append(comp)
+    edges = []
+    for i in range(nodes):
+        target = i + 1 if rng.random() < 0.5 and (i + 1) % columns else i + columns
+        if target < nodes:
+            edges.append({"source": f"n{i}", "target": f"n{target}", "label": "calls"})
+    return components, edges
+
+def write_corpus(directory, files, rng):
+    """Writes `files` sample .drawio files of NODES_PER_SAMPLE vertices each."""
+    os.makedirs(directory, exist_ok=True)
+    for f in range(files):
+        with open(os.path.join(directory, f"sample_{f:05d}.drawio"), "w", encoding="utf-8") as out:
+            writer = tools.DrawioWriter(out)
+            writer.start()
+            for i in range(NODES_PER_SAMPLE):
+                writer.vertex(f"s{f}-{i}", f"component-{i}", STYLES[i % len(STYLES)],
+                              (i % 10) * GRID_SPACING, (i // 10) * GRID_SPACING, 120, 60)
+            writer.end()
+
+def measure(fn, repeat):
+    """Best wall time of `repeat` runs, then one more run under tracemalloc for peak memory."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+@contextlib.contextmanager
+def workspace():
+    """Runs a case in a scratch directory with its own library and output folder."""
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="diagram-bench-")
+    os.chdir(directory)
+    try:
+        yield directory
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def bench_generate(sizes, repeat, rng):
+    library = synthetic_library(50, rng)
+    library_ids = [item["id"] for item in library]
+    with workspace():
+        with open(tools.LIBRARY_PATH, "w", encoding="utf-8") as f:
+            json.dump(library, f)
+        for size in sizes:
+            components, edges = synthetic_graph(size, library_ids, rng)
+            # Repeats generate the same spec; skip_unchanged would turn all but the first into a hash check
+            yield f"generate/stream/{size}", size, measure(
+                lambda: tools.generate_drawio_xml(components, edges, "bench", stream=True, skip_unchanged=False), repeat)
+            yield f"generate/string/{size}", size, measure(
+                lambda: tools.generate_drawio_xml(components, edges, "bench", skip_unchanged=False), repeat)
+            # The repeat-run path: build the document, find it identical to the latest version, write nothing
+            yield f"generate/unchanged/{size}", size, measure(
+                lambda: tools.generate_drawio_xml(components, edges, "bench", stream=True), repeat)
+            base = tools.generate_drawio_xml(components, edges, "bench", stream=True, skip_unchanged=False)["path"]
+            yield f"generate/patch_one/{size}", size, measure(
+                lambda: tools.patch_drawio_xml(base, update_components=[{"id": "n0", "label": "patched", "x": -GRID_SPACING}],
+                                               add_edges=[{"source": "n0", "target": f"n{size - 1}"}],
+                                               skip_unchanged=False), repeat)
+            if size <= 10000:
+                unplaced, unplaced_edges = synthetic_graph(size, library_ids, rng, positioned=False)
+                yield f"generate/autolayout/{size}", size, measure(
+                    lambda: tools.generate_drawio_xml(unplaced, unplaced_edges, "bench", stream=True, skip_unchanged=False), repeat)
+                # Validation alone on the auto-laid-out graph, whose edges are long and often blocked
+                records, model_edges, _ = tools.build_diagram_model(unplaced, unplaced_edges, tools.get_library_store().by_id())
+                tools.layout_components(records, model_edges)
+                yield f"generate/validate/{size}", size + len(model_edges), measure(
+                    lambda: tools.validate_layout(records, model_edges), repeat)
+            # Old versions are not needed and would only fill the disk
+            shutil.rmtree(tools.VERSIONS_DIR, ignore_errors=True)
+
+def bench_library(sizes, repeat, rng):
+    with workspace():
+        for size in sizes:
+            with open(tools.LIBRARY_PATH, "w", encoding="utf-8") as f:
+                json.dump(synthetic_library(size, rng), f)
+            yield f"library/cold_load/{size}", size, measure(
+                lambda: tools.LibraryStore(tools.LIBRARY_PATH).items(), repeat)
+            store = tools.get_library_store()
+            store.items()
+            yield f"library/warm_load/{size}", size, measure(tools.load_library, repeat)
+            yield f"library/list_components/{size}", size, measure(tools.list_components, repeat)
+            yield f"library/list_compact_filtered/{size}", size, measure(
+                lambda: tools.list_components(category="database", compact=True, limit=50), repeat)
+
+def bench_extract(file_counts, repeat, rng):
+    workers = os.cpu_count() or 1
+    with workspace() as directory:
+        for files in file_counts:
+            corpus = os.path.join(directory, f"corpus_{files}")
+            write_corpus(corpus, files, rng)
+            nodes = files * NODES_PER_SAMPLE
+            yield f"extract/full/{files}_files", nodes, measure(
+                lambda: extractor.build_library(corpus, 1, "bench_library.json"), repeat)
+            if workers > 1:
+                yield f"extract/full_parallel/{files}_files", nodes, measure(
+                    lambda: extractor.build_library(corpus, workers, "bench_library.json"), repeat)
+            yield f"extract/incremental_noop/{files}_files", nodes, measure(
+                lambda: extractor.update_library(corpus, 1, "bench_library.json"), repeat)
+
+CASES = {
+    "generate": lambda args, rng: bench_generate(args.sizes, args.repeat, rng),
+    "library": lambda args, rng: bench_library(args.sizes, args.repeat, rng),
+    "extract": lambda args, rng: bench_extract(args.corpus_files, args.repeat, rng),
+}
+
+def scaling_exponent(points):
+    """Least-squares slope of log(time) over log(size); 1.0 means linear scaling."""
+    points = [(math.log(n), math.log(t)) for n, t in points if n > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the diagram tools.")
+    parser.add_argument('--quick', action='store_true', help="skip the largest sizes")
+    parser.add_argument('--only', choices=sorted(CASES), action='append', help="run only these case families")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative slowdown that counts as a regression (default 0.25)")
+    parser.add_argument('--output', help="also write the results as JSON here")
+    args = parser.parse_args()
+    args.sizes = QUICK_SIZES if args.quick else SIZES
+    args.corpus_files = QUICK_CORPUS_FILES if args.quick else CORPUS_FILES
+
+    try:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    baseline_path = os.path.abspath(args.baseline)
+
+    rng = random.Random(args.seed)
+    results = {}
+    regressions = []
+    print(f"{'case':<44}{'seconds':>12}{'items/s':>14}{'peak MiB':>10}{'vs base':>10}")
+    for family in args.only or sorted(CASES):
+        cases = CASES[family](args, rng)
+        while True:
+            # The library code prints progress lines; keep the table readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                case = next(cases, None)
+            if case is None:
+                break
+            name, items, (seconds, peak) = case
+            results[name] = {"items": items, "seconds": seconds, "items_per_second": items / seconds if seconds else None, "peak_bytes": peak}
+            change = ""
+            base = baseline.get(name)
+            if base:
+                ratio = seconds / base["seconds"] - 1
+                change = f"{ratio:+.0%}"
+                if ratio > args.threshold:
+                    regressions.append(name)
+                    change += " !"
+            print(f"{name:<44}{seconds:>12.5f}{items / seconds:>14,.0f}{peak / 2**20:>10.1f}{change:>10}")
+
+    print("\nScaling (slope of log time over log size, 1.0 = linear):")
+    series = {}
+    for name, result in results.items():
+        series.setdefault(name.rsplit('/', 1)[0], []).append((result["items"], result["seconds"]))
+    for name, points in series.items():
+        slope = scaling_exponent(points)
+        if slope is not None:
+            print(f"  {name:<42}{slope:>6.2f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"\nSaved baseline to {baseline_path}")
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}: " + ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
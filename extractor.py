@@ -2,55 +2,133 @@ import json
 import html
 import xml.etree.ElementTree as ET
 from html.parser import HTMLParser
-import sys
 import os
 import glob
+import hashlib
+from tools import component_role, short_label, decode_diagram, iter_decoded_diagram, style_fingerprint
+import tracing
 
 class DrawIOHTMLParser(HTMLParser):
     def __init__(self):
         super().__init__()
-        self.mxgraph_data = None
+        # One entry per embedded diagram viewer; an export can carry several
+        self.mxgraph_data = []
 
     def handle_starttag(self, tag, attrs):
         if tag == 'div':
             attrs_dict = dict(attrs)
             if 'class' in attrs_dict and 'mxgraph' in attrs_dict['class'].split():
                 if 'data-mxgraph' in attrs_dict:
-                    self.mxgraph_data = attrs_dict['data-mxgraph']
+                    self.mxgraph_data.append(attrs_dict['data-mxgraph'])
 
-def parse_xml_content(root):
+def cell_to_item(cell, page=None):
+    """Turns a vertex mxCell element into a library item tagged with its page, or None for anything else."""
+    # We only care about vertices (nodes) for now, but maybe edges later?
+    # The agent primarily needs nodes to place them.
+    if cell.get('vertex', '0') != '1':
+        return None
+    geo = cell.find('mxGeometry')
+    width = geo.get('width') if geo is not None else '0'
+    height = geo.get('height') if geo is not None else '0'
+    x = geo.get('x') if geo is not None else '0'
+    y = geo.get('y') if geo is not None else '0'
+
+    # Filter out purely structural/empty nodes if they don't look meaningful
+    # But let's be inclusive for now to catch the "System Boundary"
+    value = cell.get('value', '')
+    style = cell.get('style', '')
+    return {
+        'id': cell.get('id'),
+        'value': value,
+        'style': style,
+        'category': component_role(style),
+        'label': short_label(value),
+        'width': float(width) if width else 0,
+        'height': float(height) if height else 0,
+        'x': float(x) if x else 0,
+        'y': float(y) if y else 0,
+        'page': page
+    }
+
+def is_compressed_diagram(elem):
+    return elem.tag == 'diagram' and len(elem) == 0 and bool((elem.text or '').strip())
+
+def page_name(diagram, index):
+    """Name of the index-th <diagram> page, falling back to draw.io's default."""
+    return diagram.get('name') or f"Page-{index + 1}"
+
+def parse_model(model, page):
+    """Library items of one page's graph model."""
+    items = []
+    for cell in model.iter('mxCell'):
+        item = cell_to_item(cell, page)
+        if item is not None:
+            items.append(item)
+    return items
+
+def parse_xml_content(root, default_page="Page-1"):
+    """
+    Library items of a parsed document, page by page. A bare <mxGraphModel>
+    (as embedded in HTML exports) is a single page called default_page.
+    """
+    diagrams = list(root.iter('diagram'))
+    if not diagrams:
+        return parse_model(root, default_page)
     library = []
-    # Find all mxCell elements recursively
-    for cell in root.iter('mxCell'):
-        cell_id = cell.get('id')
-        value = cell.get('value', '')
-        style = cell.get('style', '')
-        vertex = cell.get('vertex', '0')
-        
-        # We only care about vertices (nodes) for now, but maybe edges later?
-        # The agent primarily needs nodes to place them. 
-        if vertex == '1':
-            geo = cell.find('mxGeometry')
-            width = geo.get('width') if geo is not None else '0'
-            height = geo.get('height') if geo is not None else '0'
-            x = geo.get('x') if geo is not None else '0'
-            y = geo.get('y') if geo is not None else '0'
-            
-            # Filter out purely structural/empty nodes if they don't look meaningful
-            # But let's be inclusive for now to catch the "System Boundary"
-            
-            item = {
-                'id': cell_id,
-                'value': value,
-                'style': style,
-                'width': float(width) if width else 0,
-                'height': float(height) if height else 0,
-                'x': float(x) if x else 0,
-                'y': float(y) if y else 0
-            }
-            library.append(item)
+    for index, diagram in enumerate(diagrams):
+        # Compressed pages carry their graph model as text instead of child elements
+        model = ET.fromstring(decode_diagram(diagram.text)) if is_compressed_diagram(diagram) else diagram
+        library.extend(parse_model(model, page_name(diagram, index)))
     return library
 
+def iter_xml_components(source):
+    """
+    Streams library items out of a draw.io file (path or file object) with iterparse.
+    Items are tagged with the page they come from. Each cell is cleared and
+    detached from the tree once it has been turned into an item, and each page
+    once it has been read, so the parse tree never holds more than the cell
+    being read, whatever the size or page count of the document. Compressed
+    pages are inflated chunk by chunk into the same loop. (extract_from_xml
+    still collects the items themselves into a list.)
+    """
+    return stream_items(ET.iterparse(source, events=('start', 'end')), "Page-1")
+
+def decoded_events(text):
+    """(event, element) pairs of a compressed page, parsed as it is inflated."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    for chunk in iter_decoded_diagram(text):
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def stream_items(events, page):
+    pages = 0
+    # The open elements: a finished cell or page is removed from its parent
+    path = []
+    for event, elem in events:
+        if event == 'start':
+            path.append(elem)
+            if elem.tag == 'diagram':
+                page = page_name(elem, pages)
+                pages += 1
+            continue
+        path.pop()
+        item = None
+        if elem.tag == 'diagram':
+            if is_compressed_diagram(elem):
+                yield from stream_items(decoded_events(elem.text), page)
+            elem.clear()
+        elif elem.tag == 'mxCell':
+            item = cell_to_item(elem, page)
+            elem.clear()
+        # Cells (or their <object> wrappers) sit in <root>, pages in <mxfile>;
+        # the earlier siblings are gone already, so this removes the first child
+        if path and path[-1].tag in ('root', 'mxfile'):
+            path[-1].remove(elem)
+        if item is not None:
+            yield item
+
 def extract_from_html(file_path):
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -62,69 +140,287 @@ def extract_from_html(file_path):
         if not parser.mxgraph_data:
             print(f"No mxgraph data found in {file_path}")
             return []
-            
-        data = json.loads(parser.mxgraph_data)
-        xml_content = data.get('xml')
-        if not xml_content:
-            return []
-            
-        # Try unescaping
-        try:
-            # Often it's double encoded or just xml string
-            unescaped_xml = html.unescape(xml_content)
-            root = ET.fromstring(unescaped_xml)
-        except ET.ParseError:
-            # Fallback
-            root = ET.fromstring(xml_content)
-            
-        return parse_xml_content(root)
+
+        library = []
+        for index, mxgraph_data in enumerate(parser.mxgraph_data):
+            data = json.loads(mxgraph_data)
+            xml_content = data.get('xml')
+            if not xml_content:
+                continue
+
+            if not xml_content.lstrip().startswith('<'):
+                # Older exports embed the compressed graph model directly
+                xml_content = decode_diagram(xml_content)
+
+            # Try unescaping
+            try:
+                # Often it's double encoded or just xml string
+                unescaped_xml = html.unescape(xml_content)
+                root = ET.fromstring(unescaped_xml)
+            except ET.ParseError:
+                # Fallback
+                root = ET.fromstring(xml_content)
+
+            library.extend(parse_xml_content(root, default_page=f"Page-{index + 1}"))
+        return library
     except Exception as e:
         print(f"Error parsing HTML {file_path}: {e}")
         return []
 
 def extract_from_xml(file_path):
     try:
-        tree = ET.parse(file_path)
-        return parse_xml_content(tree.getroot())
+        return list(iter_xml_components(file_path))
     except Exception as e:
         print(f"Error parsing XML {file_path}: {e}")
         return []
 
-def build_library(sample_dir):
+def find_sample_files(sample_dir):
+    """Returns the sample files in processing order: .drawio files first, then .html, each sorted."""
+    xml_files = sorted(glob.glob(os.path.join(sample_dir, "*.drawio")))
+    # *.html also matches .drawio.html exports
+    html_files = sorted(glob.glob(os.path.join(sample_dir, "*.html")))
+    return xml_files + html_files
+
+def extract_file(filepath):
+    """Extracts the components of one sample file, dispatching on its extension."""
+    print(f"Processing {filepath}...")
+    with tracing.span("extract.file", path=filepath) as sp:
+        if filepath.endswith('.html'):
+            components = extract_from_html(filepath)
+        else:
+            components = extract_from_xml(filepath)
+        if tracing.enabled():
+            sp.set(bytes=os.path.getsize(filepath), components=len(components))
+    return components
+
+def extract_files(files, workers=1):
+    """
+    Yields (filepath, components) for each file in input order.
+    With workers > 1 the files are parsed in a process pool; results are still
+    yielded in input order so merging stays deterministic.
+    """
+    if workers <= 1 or len(files) <= 1:
+        for filepath in files:
+            yield filepath, extract_file(filepath)
+        return
+    # Imported here: it pulls in multiprocessing and logging, which single-process runs never need
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from zip(files, pool.map(extract_file, files, chunksize=chunksize))
+
+# Per-alias overrides kept when components are collapsed; everything else comes from the canonical entry
+ALIAS_FIELDS = ('value', 'width', 'height')
+
+def merge_components(results):
+    """
+    Merges per-file component lists, keeping the first occurrence of each id.
+    Components whose style has the same fingerprint (see tools.style_fingerprint)
+    are collapsed into the first of them. Its 'aliases' list has one entry per
+    other component: the id plus whichever of ALIAS_FIELDS differ from the
+    canonical entry, so the alias still renders with its own value and size.
+    """
     all_components = []
     seen_ids = set()
-    
-    print(f"Scanning {sample_dir}...")
-
-    # Process Drawio XML files first
-    xml_files = glob.glob(os.path.join(sample_dir, "*.drawio"))
-    print(f"Found XML files: {xml_files}")
-    for filepath in xml_files:
-        print(f"Processing {filepath}...")
-        components = extract_from_xml(filepath)
-        for comp in components:
-            if comp['id'] not in seen_ids:
-                all_components.append(comp)
-                seen_ids.add(comp['id'])
-
-    # Process HTML files
-    html_files = glob.glob(os.path.join(sample_dir, "*.html")) 
-    # Also catch .drawio.html if glob didn't match *.html? usually *.html matches .drawio.html
-    print(f"Found HTML files: {html_files}")
-    for filepath in html_files:
-        print(f"Processing {filepath}...")
-        components = extract_from_html(filepath)
+    canonical = {}
+    for _, components in results:
         for comp in components:
-            if comp['id'] not in seen_ids:
+            if comp['id'] in seen_ids:
+                continue
+            seen_ids.add(comp['id'])
+            fingerprint = style_fingerprint(comp['style'])
+            first = canonical.get(fingerprint)
+            if first is None:
+                comp = {key: value for key, value in comp.items() if key != 'aliases'}
+                canonical[fingerprint] = comp
                 all_components.append(comp)
-                seen_ids.add(comp['id'])
+            else:
+                alias = {'id': comp['id']}
+                alias.update((key, comp[key]) for key in ALIAS_FIELDS if comp.get(key) != first.get(key))
+                first.setdefault('aliases', []).append(alias)
+    return all_components
+
+MANIFEST_VERSION = 3
+
+def manifest_path_for(output_path):
+    """library.json -> library.manifest.json"""
+    return os.path.splitext(output_path)[0] + '.manifest.json'
+
+def file_digest(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_entry(filepath, ids, digest=None):
+    """Manifest entry for one sample file: stat signature, content hash and the ids it yielded."""
+    st = os.stat(filepath)
+    return {
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'sha256': digest or file_digest(filepath),
+        'ids': ids,
+    }
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+def save_manifest(manifest_path, sample_dir, entries):
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': MANIFEST_VERSION, 'sample_dir': sample_dir, 'files': entries}, f, indent=2)
+
+def save_library(output_path, components):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(components, f, indent=2)
+
+def build_library(sample_dir, workers=1, output_path='library.json'):
+    """Extracts every sample file and rewrites the library and its manifest from scratch."""
+    with tracing.span("library.build", sample_dir=sample_dir, workers=workers) as sp:
+        components = _build_library(sample_dir, workers, output_path)
+        sp.set(components=len(components))
+    return components
+
+def _build_library(sample_dir, workers, output_path):
+    print(f"Scanning {sample_dir}...")
+
+    files = find_sample_files(sample_dir)
+    print(f"Found {len(files)} sample files")
+    results = list(extract_files(files, workers))
+    all_components = merge_components(results)
 
     print(f"Extracted {len(all_components)} total components.")
-    
-    with open('library.json', 'w', encoding='utf-8') as f:
-        json.dump(all_components, f, indent=2)
-    print("Saved to library.json")
+
+    save_library(output_path, all_components)
+    entries = {path: file_entry(path, [comp['id'] for comp in components]) for path, components in results}
+    save_manifest(manifest_path_for(output_path), sample_dir, entries)
+    print(f"Saved to {output_path}")
+    return all_components
+
+def update_library(sample_dir, workers=1, output_path='library.json'):
+    """
+    Incrementally refreshes the library using the manifest written by the last build.
+    Only added or changed files are re-extracted (a file whose mtime/size moved but
+    whose hash did not is treated as unchanged), components of deleted files are
+    dropped, and the library is re-merged in file order. Falls back to a full
+    build_library() when there is no usable manifest or library.
+    """
+    manifest_path = manifest_path_for(output_path)
+    manifest = load_manifest(manifest_path)
+    try:
+        with open(output_path, 'r', encoding='utf-8') as f:
+            library = {item['id']: item for item in json.load(f)}
+    except (FileNotFoundError, json.JSONDecodeError):
+        library = None
+    if manifest is None or library is None:
+        print("No usable manifest, doing a full rebuild")
+        return build_library(sample_dir, workers, output_path)
+
+    old_entries = manifest['files']
+    files = find_sample_files(sample_dir)
+    entries = {}
+    dirty = []
+    touched = False
+    for path in files:
+        entry = old_entries.get(path)
+        if entry is None:
+            dirty.append(path)
+            continue
+        st = os.stat(path)
+        if st.st_mtime_ns == entry['mtime_ns'] and st.st_size == entry['size']:
+            entries[path] = entry
+            continue
+        digest = file_digest(path)
+        if digest == entry['sha256']:
+            entries[path] = file_entry(path, entry['ids'], digest)
+            touched = True
+        else:
+            dirty.append(path)
+    removed = [path for path in old_entries if path not in entries and path not in dirty]
+    removed += [path for path in dirty if path in old_entries]
+
+    if not dirty and not removed:
+        if touched:
+            save_manifest(manifest_path, sample_dir, entries)
+        print(f"Library is up to date ({len(library)} components)")
+        return list(library.values())
+
+    # Ids that lost their source. An unchanged file that also yields one of them was
+    # shadowed by the lost copy, and its own copy is not in the library: re-extract it.
+    lost_ids = {cid for path in removed for cid in old_entries[path]['ids']}
+    for path in list(entries):
+        if lost_ids.intersection(entries[path]['ids']):
+            del entries[path]
+            dirty.append(path)
+
+    print(f"{len(dirty)} files to extract, {len([p for p in removed if p not in files])} removed")
+    fresh = dict(extract_files(sorted(dirty, key=files.index), workers))
+
+    # Aliases keep only their id and ALIAS_FIELDS, so an unchanged file's aliased
+    # components are rebuilt from their canonical entry. If that entry is gone, or
+    # now has another style, the files its aliases came from are re-extracted
+    # instead: one of them provides the new canonical entry with all of its fields.
+    # The canonical entry of an id came from the first file, in manifest order, that yielded it
+    owner = {}
+    for path, entry in old_entries.items():
+        for cid in entry['ids']:
+            owner.setdefault(cid, path)
+
+    def still_canonical(cid):
+        """True when the file the canonical entry came from still yields it with the same style."""
+        copy = next((comp for comp in fresh.get(owner.get(cid), ()) if comp['id'] == cid), None)
+        return copy is not None and style_fingerprint(copy['style']) == style_fingerprint(library[cid]['style'])
+
+    orphaned = {alias['id'] for cid in lost_ids if cid in library and library[cid].get('aliases')
+                and not still_canonical(cid) for alias in library[cid]['aliases']}
+    stale = [path for path in files if path in entries and orphaned.intersection(entries[path]['ids'])]
+    if stale:
+        print(f"{len(stale)} unchanged files re-extracted for orphaned aliases")
+        fresh.update(extract_files(stale, workers))
+    for path, components in fresh.items():
+        entries[path] = file_entry(path, [comp['id'] for comp in components])
+
+    canonical_of = {alias['id']: (item, alias) for item in library.values() for alias in item.get('aliases', ())}
+
+    def cached(cid):
+        if cid in library:
+            return library[cid]
+        item, alias = canonical_of[cid]
+        return {**item, **alias}
+
+    def per_file():
+        for path in files:
+            if path in fresh:
+                yield path, fresh[path]
+            else:
+                yield path, [cached(cid) for cid in entries[path]['ids'] if cid in library or cid in canonical_of]
+
+    all_components = merge_components(per_file())
+    print(f"Library now has {len(all_components)} components.")
+
+    save_library(output_path, all_components)
+    save_manifest(manifest_path, sample_dir, {path: entries[path] for path in files})
+    print(f"Saved to {output_path}")
+    return all_components
 
 if __name__ == '__main__':
-    sample_dir = sys.argv[1] if len(sys.argv) > 1 else 'sample'
-    build_library(sample_dir)
+    import argparse
+    parser = argparse.ArgumentParser(description="Builds library.json from sample diagrams.")
+    parser.add_argument('sample_dir', nargs='?', default='sample')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of extraction processes (default: 1, no pool)")
+    parser.add_argument('-o', '--output', default='library.json')
+    parser.add_argument('--full', action='store_true',
+                        help="ignore the manifest and re-extract every file")
+    args = parser.parse_args()
+    if args.full:
+        build_library(args.sample_dir, workers=args.workers, output_path=args.output)
+    else:
+        update_library(args.sample_dir, workers=args.workers, output_path=args.output)
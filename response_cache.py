@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking, one process per cache file
+    fcntl = None
+
+CACHE_PATH = '.agent_cache.json'
+MAX_ENTRIES = 256
+
+def normalize_prompt(prompt):
+    """Case- and whitespace-insensitive form of a prompt."""
+    return re.sub(r'\s+', ' ', prompt).strip().lower()
+
+def cache_key(prompt, instruction, library_digest, model_name=""):
+    """Key for a prompt under one agent instruction, library content and model."""
+    h = hashlib.sha256()
+    for part in (normalize_prompt(prompt), hashlib.sha256(instruction.encode('utf-8')).hexdigest(), library_digest, model_name):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+class ResponseCache:
+    """
+    On-disk LRU cache of generate_drawio_xml specs keyed by cache_key().
+    Entries are kept in least- to most-recently-used order and the oldest are
+    evicted beyond max_entries. A hit only reorders the entries in memory; the
+    file is rewritten atomically by put() and save(), which hold an flock on
+    `<path>.lock` and merge in what other processes (agent.py, service.py)
+    wrote meanwhile. hits, misses and seconds_saved count this process only.
+    """
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        # Keys used since the last save, least recent first
+        self._touched = OrderedDict()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return OrderedDict(json.load(f).get("entries", {}))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return OrderedDict()
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save(self):
+        """Merges the keys used here into the file's current entries and writes it back."""
+        with self._file_lock():
+            entries = self._load()
+            for key in self._touched:
+                entries[key] = self._entries[key]
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"entries": entries}, f)
+            os.replace(tmp_path, self.path)
+        self._entries = entries
+        self._touched.clear()
+
+    def get(self, key):
+        """Returns the cached entry ({'spec', 'seconds'}) and marks it recently used, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            self._touched[key] = None
+            self._touched.move_to_end(key)
+            return entry
+
+    def put(self, key, spec, seconds):
+        """Stores the spec of a model run that took `seconds`."""
+        with self._lock:
+            self._entries[key] = {"spec": spec, "seconds": seconds}
+            self._entries.move_to_end(key)
+            self._touched[key] = None
+            self._touched.move_to_end(key)
+            self._save()
+
+    def save(self):
+        """Writes the recency of entries hit since the last write, if any."""
+        with self._lock:
+            if self._touched:
+                self._save()
+
+    def record_saved(self, seconds):
+        with self._lock:
+            self.seconds_saved += max(seconds, 0.0)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "seconds_saved": round(self.seconds_saved, 3),
+        }
+
+    def report(self):
+        s = self.stats()
+        print(f"Cache: {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.0%} hit rate), "
+              f"{s['seconds_saved']:.2f}s saved, {s['entries']} entries")
@@ -0,0 +1,225 @@
+"""
+Long-running local service that keeps the agent, runner, response cache and
+component library warm between requests.
+
+    python service.py                              # http://127.0.0.1:8765
+    python service.py --socket /tmp/diagram.sock   # HTTP over a Unix socket
+    python service.py --stub --stub-latency 0.5    # offline, no Gemini calls
+
+Routes (JSON in, JSON out):
+    POST /prompt    {"prompt": "..."}       agent result record, as in agent.py --batch
+    POST /generate  {"components": [...], "edges": [...], ...}
+                    one generate_drawio_batch record, no model involved
+    GET  /health    uptime, request counts, library and cache statistics
+
+Requests are served concurrently: each connection gets a thread, agent runs
+share one Runner on a background event loop with at most --concurrency of
+them in flight, and /generate calls run directly in their request thread.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import agent
+import tracing
+from response_cache import ResponseCache, CACHE_PATH, MAX_ENTRIES
+from tools import generate_drawio_batch, get_library_store
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 16 << 20
+
+class DiagramService:
+    """
+    The warm state shared by all requests. The agent and runner are created
+    once; agent runs are scheduled on an event loop owned by a background
+    thread so that request threads can wait on them.
+    """
+    def __init__(self, model=agent.DEFAULT_MODEL, concurrency=4, cache=None):
+        self.cache = cache
+        self.started_at = time.time()
+        self.requests = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        with tracing.span("service.warm"):
+            self.runner = agent.create_runner(agent.create_agent(model))
+            get_library_store().items()
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="agent-loop", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _count(self, error):
+        with self._lock:
+            self.requests += 1
+            self.failed += bool(error)
+
+    async def _run_prompt(self, prompt):
+        async with self._semaphore:
+            return await agent.run_prompt(self.runner, prompt, cache=self.cache)
+
+    def prompt(self, prompt):
+        """Runs one prompt through the shared runner and waits for its result record."""
+        result = asyncio.run_coroutine_threadsafe(self._run_prompt(prompt), self._loop).result()
+        self._count(result["error"])
+        return result
+
+    def generate(self, spec):
+        """Generates one component/edge spec without the model. Never raises."""
+        result = generate_drawio_batch([spec])[0]
+        del result["index"]
+        self._count(result["error"])
+        return result
+
+    def health(self):
+        store = get_library_store()
+        with self._lock:
+            status = {"status": "ok", "uptime": round(time.time() - self.started_at, 3),
+                      "requests": self.requests, "failed": self.failed}
+        status["library"] = {"items": len(store.items()), "hits": store.hits, "reloads": store.reloads}
+        if self.cache is not None:
+            status["cache"] = {"hits": self.cache.hits, "misses": self.cache.misses,
+                               "seconds_saved": round(self.cache.seconds_saved, 3)}
+        return status
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so a client sending many requests pays for one connection
+    protocol_version = "HTTP/1.1"
+    server_version = "DiagramService/1"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, self.server.service.health())
+        else:
+            self._reply(404, {"error": f"no route GET {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ("/prompt", "/generate"):
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self._reply(404, {"error": f"no route POST {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body's extent is unknown, so the connection cannot be reused
+            self.close_connection = True
+            self._reply(400, {"error": "invalid Content-Length"})
+            return
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self._reply(413, {"error": f"request body over {MAX_BODY_BYTES} bytes"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._reply(400, {"error": f"invalid JSON: {e}"})
+            return
+        if not isinstance(body, dict):
+            self._reply(400, {"error": "request body must be a JSON object"})
+            return
+        service = self.server.service
+        with tracing.span("service.request", route=self.path, bytes=length):
+            if self.path == "/generate":
+                self._reply(200, service.generate(body))
+                return
+            prompt = body.get("prompt")
+            if not isinstance(prompt, str) or not prompt.strip():
+                self._reply(400, {"error": "'prompt' must be a non-empty string"})
+                return
+            self._reply(200, service.prompt(prompt))
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # One line per request would dominate the cost of cache hits
+        tracing.debug(lambda: f"{self.address_string()} {format % args}")
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix socket peers have no address; BaseHTTPRequestHandler expects a (host, port) pair
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+def _remove_stale_socket(path):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """HTTP server for a DiagramService, on a Unix socket when socket_path is given, else on host:port."""
+    if socket_path:
+        _remove_stale_socket(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    return server
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """Serves until interrupted, then shuts the service down."""
+    server = make_server(service, host, port, socket_path)
+    where = socket_path or "http://%s:%d" % server.server_address[:2]
+    print(f"Serving diagrams on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if socket_path:
+            _remove_stale_socket(socket_path)
+        if service.cache is not None:
+            service.cache.save()
+            service.cache.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves diagram generation from a warm agent.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', metavar='PATH', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--concurrency', type=int, default=4, help="agent runs in flight at once")
+    parser.add_argument('--stub', action='store_true', help="use the offline stub model instead of Gemini")
+    parser.add_argument('--stub-latency', type=float, default=0.0)
+    parser.add_argument('--no-cache', action='store_true', help="always call the model")
+    parser.add_argument('--cache-path', default=CACHE_PATH)
+    parser.add_argument('--cache-size', type=int, default=MAX_ENTRIES, help="max cached prompts (LRU)")
+    parser.add_argument('--trace', metavar='FILE', help="append timing spans to FILE as JSONL")
+    parser.add_argument('--debug', action='store_true', help="print debug dumps and request lines")
+    args = parser.parse_args()
+
+    if args.trace:
+        tracing.configure(path=args.trace)
+    if args.debug:
+        tracing.set_debug(True)
+
+    model = agent.stub_llm(args.stub_latency) if args.stub else agent.DEFAULT_MODEL
+    cache = None if args.no_cache else ResponseCache(args.cache_path, args.cache_size)
+    serve(DiagramService(model, args.concurrency, cache), args.host, args.port, args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,8 @@ if components:
 
 print("\nGenerating XML...")
 # Create a simple diagram: User -> Web Client
-user_id = components[5]['id'] # "Website User" based on index 5 in library.json viewing
-web_client_id = components[1]['id'] # "planner-web-client"
+user_id = list_components(category='actor')[0]['id'] # "Website User"
+web_client_id = list_components(category='container')[0]['id'] # "planner-web-client"
 
 test_components = [
     {'id': 'user', 'library_id': user_id, 'x': 100, 'y': 100, 'label': 'Visitor'},
@@ -0,0 +1,151 @@
+"""
+Incremental library rebuilds (update_library) must match a full build_library,
+and style-deduplicated components must keep resolving as their aliases.
+"""
+import json
+import os
+
+import pytest
+
+import extractor
+import tools
+
+SERVICE = "rounded=0;whiteSpace=wrap;html=1;"
+DATABASE = "shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;size=15;"
+QUEUE = "shape=mxgraph.aws4.queue;html=1;"
+
+def cell(cell_id, value, style, width=120, height=60):
+    return (f'<mxCell id="{cell_id}" value="{value}" style="{style}" vertex="1" parent="1">'
+            f'<mxGeometry x="10" y="20" width="{width}" height="{height}" as="geometry"/></mxCell>')
+
+def write_sample(path, *cells):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<mxfile><diagram name="Page-1" id="p"><mxGraphModel><root>'
+                '<mxCell id="0"/><mxCell id="1" parent="0"/>'
+                + "".join(cells) + '</root></mxGraphModel></diagram></mxfile>')
+
+@pytest.fixture
+def samples(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir("sample")
+    os.mkdir("full")
+    return "sample"
+
+def assert_matches_full_build(sample_dir):
+    """Updates library.json in place and compares it with a from-scratch build."""
+    incremental = extractor.update_library(sample_dir)
+    full = extractor.build_library(sample_dir, output_path=os.path.join("full", "library.json"))
+    assert incremental == full
+    with open("library.json", encoding='utf-8') as a, open(os.path.join("full", "library.json"), encoding='utf-8') as b:
+        assert json.load(a) == json.load(b)
+    with open("library.manifest.json", encoding='utf-8') as a, open(os.path.join("full", "library.manifest.json"), encoding='utf-8') as b:
+        assert json.load(a)['files'].keys() == json.load(b)['files'].keys()
+    return incremental
+
+def test_update_matches_full_build_after_add_modify_delete(samples):
+    write_sample("sample/a.drawio", cell("a1", "api", SERVICE), cell("a2", "db", DATABASE))
+    write_sample("sample/b.drawio", cell("b1", "queue", QUEUE))
+    extractor.build_library(samples)
+
+    write_sample("sample/c.drawio", cell("c1", "worker", SERVICE + "fillColor=#dae8fc;"))
+    assert_matches_full_build(samples)
+
+    write_sample("sample/a.drawio", cell("a1", "api gateway", SERVICE), cell("a3", "cache", QUEUE + "dashed=1;"))
+    library = assert_matches_full_build(samples)
+    assert "a2" not in {item['id'] for item in library}
+
+    os.remove("sample/b.drawio")
+    assert_matches_full_build(samples)
+
+def test_touched_but_unchanged_file_is_not_reextracted(samples, monkeypatch):
+    write_sample("sample/a.drawio", cell("a1", "api", SERVICE))
+    before = extractor.build_library(samples)
+    st = os.stat("sample/a.drawio")
+    os.utime("sample/a.drawio", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def fail(files, workers=1):
+        raise AssertionError(f"re-extracted {list(files)}")
+    monkeypatch.setattr(extractor, "extract_files", fail)
+    assert extractor.update_library(samples) == before
+
+def test_lost_id_is_taken_from_the_shadowed_copy(samples):
+    # b.drawio yields the same id as a.drawio; only a's copy makes it into the library
+    write_sample("sample/a.drawio", cell("shared", "from a", SERVICE))
+    write_sample("sample/b.drawio", cell("shared", "from b", DATABASE), cell("b1", "queue", QUEUE))
+    extractor.build_library(samples)
+
+    os.remove("sample/a.drawio")
+    library = assert_matches_full_build(samples)
+    assert {item['id']: item['value'] for item in library}["shared"] == "from b"
+
+@pytest.mark.parametrize("change", ["delete", "restyle"])
+def test_orphaned_aliases_are_reextracted(samples, change):
+    # worker has api's style, so it is stored as an alias of api
+    write_sample("sample/a.drawio", cell("api", "api", SERVICE))
+    write_sample("sample/b.drawio", cell("worker", "worker", SERVICE, 200, 80), cell("q", "queue", QUEUE))
+    library = extractor.build_library(samples)
+    assert [alias['id'] for alias in library[0]['aliases']] == ["worker"]
+
+    if change == "delete":
+        os.remove("sample/a.drawio")
+    else:
+        write_sample("sample/a.drawio", cell("api", "api", DATABASE))
+    library = {item['id']: item for item in assert_matches_full_build(samples)}
+    assert library["worker"]['value'] == "worker"
+    assert (library["worker"]['width'], library["worker"]['height']) == (200, 80)
+    assert "aliases" not in library["worker"]
+
+def test_alias_keeps_its_own_value_and_size(samples):
+    write_sample("sample/a.drawio", cell("api", "api", SERVICE), cell("web", "web", "html=1;" + SERVICE.replace("html=1;", "")))
+    write_sample("sample/b.drawio", cell("worker", "worker", SERVICE, 200, 80), cell("api2", "api", SERVICE))
+    library = extractor.build_library(samples)
+    assert [item['id'] for item in library] == ["api"]
+    assert library[0]['aliases'] == [{'id': "web", 'value': "web"}, {'id': "worker", 'value': "worker", 'width': 200, 'height': 80}, {'id': "api2"}]
+
+    store = tools.LibraryStore("library.json")
+    worker = store.get("worker")
+    assert (worker['id'], worker['value'], worker['label'], worker['width'], worker['height']) == ("worker", "worker", "worker", 200, 80)
+    assert store.get("web")['style'] == library[0]['style']
+    assert [item['id'] for item in store.items()] == ["api"]
+
+def test_query_finds_aliases_by_id_and_label(samples):
+    write_sample("sample/a.drawio", cell("api", "api", SERVICE), cell("db", "orders", DATABASE))
+    write_sample("sample/b.drawio", cell("worker-1", "Worker&lt;br&gt;[python]", SERVICE))
+    extractor.build_library(samples)
+    assert [item['id'] for item in tools.list_components(query="WORKER-1")] == ["api"]
+    assert [item['id'] for item in tools.list_components(query="python", compact=True)] == ["api"]
+    assert [item['id'] for item in tools.list_components(query="orders")] == ["db"]
+    assert tools.list_components(query="missing") == []
+
+def test_compressed_pages_stream_like_plain_ones(tmp_path, monkeypatch):
+    cells = [cell(f"c{i}", f"Zürich 100% {i} &lt;br&gt;", SERVICE) for i in range(50)]
+    model = ('<mxGraphModel><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
+             + "".join(cells) + '</root></mxGraphModel>')
+    write_sample(tmp_path / "plain.drawio", *cells)
+    with open(tmp_path / "packed.drawio", 'w', encoding='utf-8') as f:
+        f.write('<mxfile><diagram name="Page-1" id="p">')
+        stream = tools.DeflateStream(f)
+        stream.write(model)
+        stream.close()
+        f.write('</diagram></mxfile>')
+    # Chunks of a few bytes cut through escapes and multi-byte characters
+    monkeypatch.setattr(extractor, "iter_decoded_diagram",
+                        lambda text: tools.iter_decoded_diagram(text, chunk_size=3))
+    plain = extractor.extract_from_xml(str(tmp_path / "plain.drawio"))
+    assert extractor.extract_from_xml(str(tmp_path / "packed.drawio")) == plain
+    assert [item['value'] for item in plain][-1] == "Zürich 100% 49 <br>"
+
+def test_streamed_cells_are_detached(tmp_path):
+    write_sample(tmp_path / "plain.drawio", *(cell(f"c{i}", "svc", SERVICE) for i in range(20)))
+    roots = []
+    def events():
+        for event, elem in extractor.ET.iterparse(str(tmp_path / "plain.drawio"), events=('start', 'end')):
+            if event == 'start' and elem.tag == 'root':
+                roots.append(elem)
+            yield event, elem
+    seen = set()
+    for item in extractor.stream_items(events(), "Page-1"):
+        seen.add(item['id'])
+        # The cells read so far are gone from the tree (iterparse reads ahead of the rest)
+        assert not seen & {elem.get('id') for elem in roots[0]}
+    assert len(seen) == 20 and len(roots[0]) == 0
@@ -0,0 +1,50 @@
+"""generate_drawio_xml summaries and what they report."""
+import json
+import subprocess
+import sys
+
+import pytest
+
+import tools
+
+LIBRARY = [
+    {"id": "svc", "value": "service", "style": "rounded=0;whiteSpace=wrap;html=1;", "width": 120.0, "height": 60.0},
+]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(tools.LIBRARY_PATH, "w", encoding="utf-8") as f:
+        json.dump(LIBRARY, f)
+    return tmp_path
+
+ROW = [{"id": uid, "library_id": "svc", "x": x, "y": 0} for uid, x in (("a", 0), ("m", 200), ("b", 400))]
+
+def test_routed_edges_are_not_reported_blocked(workdir, capsys):
+    result = tools.generate_drawio_xml(ROW, [{"source": "a", "target": "b"}], "row", stream=True)
+    assert result["issues"]["blocked_edges"] == []
+    assert "blocked_edges" not in capsys.readouterr().out
+    with open(result["path"], encoding="utf-8") as f:
+        assert "<mxPoint" in f.read()
+
+def test_unrouted_edges_stay_blocked(workdir):
+    result = tools.generate_drawio_xml(ROW, [{"source": "a", "target": "b"}], "row", stream=True, route=False)
+    assert result["issues"]["blocked_edges"] == [{"source": "a", "target": "b", "blockers": ["m"]}]
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_cli_writes_only_jsonl_to_stdout(workdir, workers):
+    with open("specs.jsonl", "w", encoding="utf-8") as f:
+        for prefix in ("one", "two"):
+            f.write(json.dumps({"components": ROW, "edges": [{"source": "a", "target": "x"}], "filename_prefix": prefix}) + "\n")
+    done = subprocess.run([sys.executable, tools.__file__, "specs.jsonl", "-j", str(workers)],
+                          capture_output=True, text=True, check=True)
+    results = [json.loads(line) for line in done.stdout.splitlines()]
+    assert [r["path"] for r in results] == ["architectures/one_v1.drawio", "architectures/two_v1.drawio"]
+    assert "Generated 2/2 diagrams" in done.stderr
+
+def test_agent_tool_reports_skipped_items(workdir):
+    import agent
+    components = ROW + [{"id": "ghost", "library_id": "missing"}]
+    result = agent.generate_drawio_xml(components, [{"source": "a", "target": "ghost"}], "agent_row")
+    assert result["path"] == "architectures/agent_row_v1.drawio"
+    assert [(e["kind"], e["id"]) for e in result["errors"]] == [("component", "ghost"), ("edge", "a->ghost")]
@@ -0,0 +1,61 @@
+"""layout_components on specs without coordinates."""
+import json
+
+import pytest
+
+import tools
+
+LIBRARY = [
+    {"id": "svc", "value": "service", "style": "rounded=0;whiteSpace=wrap;html=1;", "width": 120.0, "height": 60.0},
+    {"id": "db", "value": "db", "style": "shape=cylinder3;whiteSpace=wrap;html=1;size=15;", "width": 60.0, "height": 80.0},
+    {"id": "user", "value": "user", "style": "shape=umlActor;html=1;", "width": 30.0, "height": 60.0},
+    {"id": "system", "value": "", "style": "rounded=0;dashed=1;fillColor=none;html=1;", "width": 400.0, "height": 300.0},
+    {"id": "heading", "value": "System", "style": "text;html=1;", "width": 160.0, "height": 30.0},
+]
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(tools.LIBRARY_PATH, "w", encoding="utf-8") as f:
+        json.dump(LIBRARY, f)
+    return tools.get_library_store().by_id()
+
+def laid_out(library, components, edges):
+    records, model_edges, errors = tools.build_diagram_model(components, edges, library)
+    assert not errors
+    tools.layout_components(records, model_edges)
+    return records, model_edges
+
+def test_edges_to_boundary_and_title_are_ignored(library):
+    components = [{"id": "b", "library_id": "system"}, {"id": "t", "library_id": "heading"},
+                  {"id": "web", "library_id": "svc"}, {"id": "api", "library_id": "svc"}]
+    edges = [{"source": "web", "target": "api"}, {"source": "web", "target": "b"}, {"source": "t", "target": "api"}]
+    records, model_edges = laid_out(library, components, edges)
+    boxes = {comp.id: (comp.x, comp.y, comp.x + comp.width, comp.y + comp.height) for comp in records}
+    assert all(tools._rect_contains(boxes["b"], boxes[uid]) for uid in ("t", "web", "api"))
+    assert tools.validate_layout(records, model_edges)["overlaps"] == []
+    # The whole generation path, which used to fail on these edges
+    assert "<mxGraphModel" in tools.generate_drawio_xml(components, edges, skip_unchanged=False)
+
+def test_long_edges_clear_every_component(library):
+    # Chains as long as the graph, with actors and databases hanging off every tier
+    components = [{"id": "b", "library_id": "system"}]
+    edges = []
+    for i in range(60):
+        components.append({"id": f"s{i}", "library_id": "svc"})
+        components.append({"id": f"d{i}", "library_id": "db"})
+        edges.append({"source": f"s{i}", "target": f"d{i}"})
+        if i:
+            edges.append({"source": f"s{i - 1}", "target": f"s{i}"})
+        if i % 4 == 0:
+            components.append({"id": f"u{i}", "library_id": "user"})
+            edges.append({"source": f"u{i}", "target": f"s{i}"})
+            edges.append({"source": f"u{i}", "target": f"s{59 - i}"})
+    for i in range(0, 60, 7):
+        edges.append({"source": f"s{i}", "target": f"s{(i * 13) % 60}"})
+    records, model_edges = laid_out(library, components, edges)
+    report = tools.validate_layout(records, model_edges)
+    assert report["overlaps"] == [] and report["outside_boundary"] == []
+    assert report["blocked_edges"] == []
+    # Waypoints stay a few per edge however many columns it crosses
+    assert max(len(edge.points or ()) for edge in model_edges) <= 2 * (tools.LAYOUT_MAX_CHANNELS + 1) + 2
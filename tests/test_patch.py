@@ -0,0 +1,107 @@
+"""
+patch_drawio_xml must leave every cell it does not touch byte for byte as it
+was, on compressed and multi-page files; both kinds must read back through the
+extractor as they were written.
+"""
+import json
+import re
+
+import pytest
+
+import extractor
+import tools
+
+LIBRARY = [
+    {"id": "svc", "value": "service", "style": "rounded=0;whiteSpace=wrap;html=1;",
+     "width": 120.0, "height": 60.0, "x": 0.0, "y": 0.0},
+    {"id": "db", "value": "database", "style": "shape=cylinder3;whiteSpace=wrap;html=1;boundedLbl=1;size=15;",
+     "width": 80.0, "height": 100.0, "x": 0.0, "y": 0.0},
+]
+
+def page_spec(name, prefix, count):
+    """A row of `count` components with an edge between neighbours."""
+    components = [{"id": f"{prefix}{i}", "library_id": "db" if i % 3 == 2 else "svc",
+                   "label": f"{prefix}{i}", "x": 200 * i, "y": 100 * (i % 2)} for i in range(count)]
+    edges = [{"source": f"{prefix}{i}", "target": f"{prefix}{i + 1}", "label": "calls"} for i in range(count - 1)]
+    return {"name": name, "components": components, "edges": edges}
+
+PAGES = [page_spec("Front", "f", 4), page_spec("Back", "b", 8)]
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(tools.LIBRARY_PATH, "w", encoding="utf-8") as f:
+        json.dump(LIBRARY, f)
+    return tmp_path
+
+def generate(compressed):
+    result = tools.generate_drawio_xml([], [], "patched", stream=True, compressed=compressed, pages=PAGES)
+    assert not result["errors"]
+    return result["path"]
+
+def pages_of(path):
+    """[(name, raw <diagram> element, graph model text)] in file order."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    pages = []
+    for match in re.finditer(r'<diagram name="([^"]*)"[^>]*>(.*?)</diagram>', text, re.S):
+        body = match.group(2)
+        model = body if body.lstrip().startswith("<") else tools.decode_diagram(body)
+        pages.append((match.group(1), match.group(0), model))
+    return pages
+
+def cells(model):
+    """{cell id: its exact text} for the cells of a graph model."""
+    root = model[model.index("<root>") + len("<root>"):model.index("</root>")]
+    chunks = re.split(r'(?=<mxCell )', root)[1:]
+    return {re.search(r'id="([^"]*)"', chunk).group(1): chunk.rstrip() for chunk in chunks}
+
+def cell_id(cells, label):
+    return next(cid for cid, text in cells.items() if f'value="{label}"' in text)
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_patch_keeps_untouched_cells(workdir, compressed):
+    path = generate(compressed)
+    before = pages_of(path)
+    old = cells(before[1][2])
+    moved, relabeled, removed = (cell_id(old, label) for label in ("b2", "b5", "b7"))
+    attached = {cid for cid, text in old.items() if f'source="{moved}"' in text or f'target="{moved}"' in text}
+    gone = {removed} | {cid for cid, text in old.items() if f'source="{removed}"' in text or f'target="{removed}"' in text}
+
+    result = tools.patch_drawio_xml(
+        path, page="Back",
+        update_components=[{"id": "b2", "y": 400}, {"id": "b5", "label": "renamed"}],
+        remove_components=["b7"],
+        add_components=[{"id": "b9", "library_id": "svc", "label": "b9", "x": 0, "y": 600}],
+        add_edges=[{"source": "b9", "target": "b0"}])
+    assert not result["errors"]
+    assert (result["added"], result["updated"], result["removed"]) == (2, 2, 2)
+
+    after = pages_of(result["path"])
+    assert [name for name, _, _ in after] == ["Front", "Back"]
+    # The other page is not even re-encoded
+    assert after[0][1] == before[0][1]
+    new = cells(after[1][2])
+    assert old.keys() - new.keys() == gone
+    assert len(new.keys() - old.keys()) == 2
+    changed = {cid for cid in old.keys() & new.keys() if old[cid] != new[cid]}
+    assert {moved, relabeled} <= changed <= {moved, relabeled} | attached
+    assert 'value="renamed"' in new[relabeled]
+
+def extracted(path):
+    return sorted((item["page"], item["value"], item["x"], item["y"], item["width"], item["height"])
+                  for item in extractor.extract_from_xml(path))
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_extractor_reads_back_generated_pages(workdir, compressed):
+    path = generate(compressed)
+    library = {item["id"]: item for item in LIBRARY}
+    expected = sorted((page["name"], comp["label"], comp["x"], comp["y"],
+                       library[comp["library_id"]]["width"], library[comp["library_id"]]["height"])
+                      for page in PAGES for comp in page["components"])
+    assert extracted(path) == expected
+
+    patched = tools.patch_drawio_xml(path, page=1, update_components=[{"id": "b1", "label": "renamed", "x": 1000}])
+    assert not patched["errors"]
+    expected = [("Back", "renamed", 1000, *row[3:]) if row[:2] == ("Back", "b1") else row for row in expected]
+    assert extracted(patched["path"]) == sorted(expected)
@@ -0,0 +1,50 @@
+"""ResponseCache writes and how processes sharing its file see each other."""
+import json
+import threading
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache
+
+def stored(path):
+    with open(path, encoding="utf-8") as f:
+        return list(json.load(f)["entries"])
+
+def test_hits_are_written_on_save_only(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ResponseCache(path)
+    cache.put("a", {"components": []}, 1.0)
+    cache.put("b", {"components": []}, 1.0)
+    before = (tmp_path / "cache.json").stat().st_mtime_ns
+    assert cache.get("a")["seconds"] == 1.0
+    assert (tmp_path / "cache.json").stat().st_mtime_ns == before
+    assert stored(path) == ["a", "b"]
+    cache.save()
+    assert stored(path) == ["b", "a"]
+
+def test_writers_keep_each_others_entries(tmp_path):
+    path = str(tmp_path / "cache.json")
+    agent, service = ResponseCache(path, max_entries=3), ResponseCache(path, max_entries=3)
+    agent.put("a", {}, 1.0)
+    service.put("b", {}, 1.0)
+    assert agent.get("a") is not None
+    agent.put("c", {}, 1.0)
+    assert stored(path) == ["b", "a", "c"]
+    # The oldest entry across both goes first
+    service.put("d", {}, 1.0)
+    assert stored(path) == ["a", "c", "d"]
+
+@pytest.mark.skipif(response_cache.fcntl is None, reason="no file locking on this platform")
+def test_concurrent_writers_lose_nothing(tmp_path):
+    path = str(tmp_path / "cache.json")
+    def writer(name):
+        cache = ResponseCache(path)
+        for i in range(30):
+            cache.put(f"{name}{i}", {}, 1.0)
+    threads = [threading.Thread(target=writer, args=(name,)) for name in "abcd"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(stored(path)) == sorted(f"{name}{i}" for name in "abcd" for i in range(30))
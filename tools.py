@@ -1,211 +1,2520 @@
+import hashlib
+import html
 import json
-import uuid
+import math
+import os
+import re
+import sys
+import threading
+
+import tracing
+
+LIBRARY_PATH = 'library.json'
+_NOT_LOADED = object()
+
+def _style_map(style):
+    """'a=1;b;c=2;' -> {'a': '1', 'b': None, 'c': '2'}"""
+    result = {}
+    for part in style.split(';'):
+        part = part.strip()
+        if part:
+            key, _, value = part.partition('=')
+            result[key] = value if _ else None
+    return result
+
+def component_role(style):
+    """
+    Classifies a library style as boundary, title, actor, database, queue or container.
+    extractor.py stores the result as each item's 'category'.
+    """
+    styles = _style_map(style)
+    shape = styles.get('shape')
+    if 'text' in styles:
+        return 'title'
+    if shape == 'umlActor':
+        return 'actor'
+    if shape == 'cylinder3':
+        # Rotated cylinders are the message queue shape
+        return 'queue' if styles.get('direction') in ('south', 'north') else 'database'
+    if styles.get('dashed') == '1' and styles.get('fillColor') == 'none':
+        return 'boundary'
+    return 'container'
+
+def normalize_style(style):
+    """Canonical form of a style: parts trimmed, repeated keys resolved as draw.io does (last wins), keys sorted."""
+    return ';'.join(key if value is None else f"{key}={value}" for key, value in sorted(_style_map(style).items()))
+
+def style_fingerprint(style):
+    """
+    Short hash of normalize_style(style). Library items with the same fingerprint
+    draw the same shape; extractor.py collapses them into one entry.
+    """
+    return hashlib.blake2b(normalize_style(style).encode('utf-8'), digest_size=8).hexdigest()
+
+_TAG_RE = re.compile(r'<[^>]+>')
+SHORT_LABEL_LENGTH = 40
+
+def short_label(value, length=SHORT_LABEL_LENGTH):
+    """Plain-text, single-line form of an HTML cell value, truncated to `length` characters."""
+    text = html.unescape(_TAG_RE.sub(' ', value or ''))
+    text = ' '.join(text.split())
+    return text if len(text) <= length else text[:length - 1].rstrip() + '…'
+
+class LibraryStore:
+    """
+    Process-wide cache of the component library.
+    The file is parsed once and re-read only when its mtime or size changes.
+    Keeps an id index and a category index next to the ordered item list.
+    Ids listed in an item's 'aliases' (duplicates collapsed by extractor.py)
+    resolve through get() and by_id() to a copy of that item carrying the
+    alias's own id, value and size, so specs written against them render as before.
+    """
+    def __init__(self, path=LIBRARY_PATH):
+        self.path = path
+        self.hits = 0
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._signature = _NOT_LOADED
+        self._items = []
+        self._by_id = {}
+        self._by_category = {}
+        self._digest = None
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _refresh(self):
+        signature = self._stat_signature()
+        with self._lock:
+            if signature == self._signature:
+                self.hits += 1
+                return
+            items = []
+            load_span = tracing.start_span("library.load", path=self.path)
+            if signature is not None:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        items = json.load(f)
+                except FileNotFoundError:
+                    signature = None
+            by_id = {}
+            by_category = {}
+            aliases = []
+            for item in items:
+                # Libraries built before extraction stored these are filled in here
+                if "category" not in item:
+                    item["category"] = component_role(item.get("style", ""))
+                if "label" not in item:
+                    item["label"] = short_label(item.get("value", ""))
+                # Libraries built before deduplication repeat the same few styles many times
+                item["style"] = sys.intern(item.get("style", ""))
+                by_id[item["id"]] = item
+                by_category.setdefault(item["category"], []).append(item)
+                if "aliases" in item:
+                    aliases.append(item)
+            for item in aliases:
+                base = {key: value for key, value in item.items() if key != "aliases"}
+                for alias in item["aliases"]:
+                    # A real id always wins over an alias
+                    if alias["id"] not in by_id:
+                        view = {**base, **alias}
+                        if "value" in alias:
+                            view["label"] = short_label(alias["value"])
+                        by_id[alias["id"]] = view
+            self._items = items
+            self._by_id = by_id
+            self._by_category = by_category
+            self._signature = signature
+            self._digest = None
+            self.reloads += 1
+            load_span.end(bytes=signature[1] if signature else 0, items=len(items))
+
+    def items(self):
+        """Returns all library items in file order."""
+        self._refresh()
+        return self._items
+
+    def get(self, library_id):
+        """Returns the library item for an id, or None."""
+        self._refresh()
+        return self._by_id.get(library_id)
+
+    def by_id(self):
+        """Returns the {id: item} index."""
+        self._refresh()
+        return self._by_id
+
+    def by_category(self, category):
+        """Returns the items of one category."""
+        self._refresh()
+        return self._by_category.get(category, [])
+
+    def categories(self):
+        self._refresh()
+        return sorted(self._by_category)
+
+    def digest(self):
+        """sha256 of library.json's content, recomputed only after a reload."""
+        self._refresh()
+        if self._digest is None:
+            h = hashlib.sha256()
+            if self._signature is not None:
+                with open(self.path, 'rb') as f:
+                    h.update(f.read())
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def stats(self):
+        return {"hits": self.hits, "reloads": self.reloads, "items": len(self._items)}
+
+_library_store = LibraryStore()
+
+def get_library_store():
+    """Returns the process-wide LibraryStore."""
+    return _library_store
 
 def load_library():
-    """Loads the component library from library.json."""
-    try:
-        with open('library.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+    """Loads the component library from library.json (cached, see LibraryStore)."""
+    return _library_store.items()
 
-def list_components(category=None):
+def _matches(item, needle):
+    """True when `needle` is in the id or label of a library item or of one of its aliases."""
+    if needle in item["label"].lower() or needle in item["id"].lower():
+        return True
+    return any(needle in alias["id"].lower() or ("value" in alias and needle in short_label(alias["value"]).lower())
+               for alias in item.get("aliases", ()))
+
+def list_components(category=None, query=None, compact=False, offset=0, limit=None):
     """
     Lists available components in the library.
     Args:
-        category (str, optional): Filter by category (not yet implemented in extraction).
+        category (str, optional): Only components of this category: container, database,
+            queue, actor, boundary or title.
+        query (str, optional): Case-insensitive text that the label or id must contain.
+            The ids and labels of aliases count too, matching their canonical component.
+        compact (bool, optional): Return only 'id', 'label' and 'category' per component.
+        offset (int, optional): Number of matching components to skip.
+        limit (int, optional): Maximum number of components to return.
     Returns:
-        list: A list of component dictionaries with 'id', 'value', and 'style'.
+        list: Component dictionaries with 'id', 'value', 'style' and 'category'
+        (or the compact fields).
     """
-    library = load_library()
+    library = _library_store.by_category(category) if category else _library_store.items()
+    if query:
+        needle = query.lower()
+        library = [item for item in library if _matches(item, needle)]
+    offset = max(int(offset or 0), 0)
+    page = library[offset:offset + int(limit)] if limit else library[offset:]
+    if compact:
+        return [{"id": item["id"], "label": item["label"], "category": item["category"]} for item in page]
     # Return a simplified view for the agent
-    return [{"id": item["id"], "value": item["value"], "style": item["style"]} for item in library]
+    return [{"id": item["id"], "value": item["value"], "style": item["style"], "category": item["category"]} for item in page]
 
-import os
 import glob
-import xml.dom.minidom
 
-def get_next_version_filename(prefix):
-    """Finds the next version filename in architectures/ directory."""
-    base_dir = "architectures"
-    if not os.path.exists(base_dir):
-        os.makedirs(base_dir)
-    
-    # Sanitize prefix
+VERSIONS_DIR = "architectures"
+
+def _sanitize_prefix(prefix):
     safe_prefix = "".join(c for c in prefix if c.isalnum() or c in ('_', '-')).strip()
-    if not safe_prefix:
-        safe_prefix = "system_architecture"
-        
-    # Find existing files matching pattern
+    return safe_prefix or "system_architecture"
+
+def _version_hint_path(base_dir, safe_prefix):
+    return os.path.join(base_dir, f".{safe_prefix}.version")
+
+def _scan_max_version(base_dir, safe_prefix):
+    """Highest existing version for a prefix, found by globbing. Only used when there is no hint file."""
     pattern = os.path.join(base_dir, f"{safe_prefix}_v*.drawio")
-    existing_files = glob.glob(pattern)
-    
     max_version = 0
-    for f in existing_files:
+    for f in glob.glob(pattern):
+        # Extract version number: prefix_v{n}.drawio
+        name_without_ext = os.path.splitext(os.path.basename(f))[0]
+        parts = name_without_ext.split('_v')
+        if len(parts) >= 2 and parts[-1].isdigit():
+            max_version = max(max_version, int(parts[-1]))
+    return max_version
+
+def _read_version_hint(base_dir, safe_prefix):
+    try:
+        with open(_version_hint_path(base_dir, safe_prefix), 'r', encoding='utf-8') as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _write_version_hint(base_dir, safe_prefix, version):
+    # Write-then-rename so readers never see a partial file. A concurrent writer may
+    # overwrite it with a slightly older value; that only costs the next caller a retry.
+    hint_path = _version_hint_path(base_dir, safe_prefix)
+    tmp_path = f"{hint_path}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(str(version))
+    os.replace(tmp_path, hint_path)
+
+def get_next_version_filename(prefix):
+    """
+    Reserves the next version filename in the architectures/ directory.
+    The file is created empty with O_EXCL, so concurrent callers (threads or
+    processes) never get the same version. The last allocated version is kept
+    in a per-prefix hint file, making allocation O(1) instead of a directory scan.
+    """
+    base_dir = VERSIONS_DIR
+    os.makedirs(base_dir, exist_ok=True)
+
+    safe_prefix = _sanitize_prefix(prefix)
+    last_version = _read_version_hint(base_dir, safe_prefix)
+    if last_version is None:
+        last_version = _scan_max_version(base_dir, safe_prefix)
+
+    version = last_version + 1
+    while True:
+        path = os.path.join(base_dir, f"{safe_prefix}_v{version}.drawio")
         try:
-            # Extract version number: prefix_v{n}.drawio
-            filename = os.path.basename(f)
-            # Remove extension
-            name_without_ext = os.path.splitext(filename)[0]
-            # Split by _v
-            parts = name_without_ext.split('_v')
-            if len(parts) >= 2 and parts[-1].isdigit():
-                version = int(parts[-1])
-                if version > max_version:
-                    max_version = version
-        except:
-            continue
-            
-    next_version = max_version + 1
-    return os.path.join(base_dir, f"{safe_prefix}_v{next_version}.drawio")
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            break
+        except FileExistsError:
+            version += 1
+    _write_version_hint(base_dir, safe_prefix, version)
+    return path
+
+def _latest_version_path(base_dir, safe_prefix):
+    version = _read_version_hint(base_dir, safe_prefix)
+    if version is None:
+        version = _scan_max_version(base_dir, safe_prefix)
+    return os.path.join(base_dir, f"{safe_prefix}_v{version}.drawio") if version else None
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.digest()
+
+class _DigestFile:
+    """
+    Binary file wrapper that hashes and counts everything written to it.
+    Text is encoded as UTF-8 and buffered, since DrawioWriter writes line by line.
+    """
+    BUFFER_CHARS = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self._pending = []
+        self._pending_chars = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            self._pending.append(data)
+            self._pending_chars += len(data)
+            if self._pending_chars >= self.BUFFER_CHARS:
+                self.flush()
+            return
+        self.flush()
+        self._write_bytes(data)
+
+    def _write_bytes(self, data):
+        self.hash.update(data)
+        self.f.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        if self._pending:
+            self._write_bytes("".join(self._pending).encode('utf-8'))
+            self._pending = []
+            self._pending_chars = 0
+
+def save_version(prefix, write, skip_unchanged=True):
+    """
+    Saves a new version of `prefix` whose content is produced by write(sink).
+    The content goes to a temporary file, hashed while it is written. When it is
+    byte-identical to the latest version of the prefix, the temporary file is
+    dropped and the existing path is returned; otherwise the next version is
+    reserved and the file is moved into place. Returns (path, bytes, unchanged).
+    """
+    base_dir = VERSIONS_DIR
+    os.makedirs(base_dir, exist_ok=True)
+    safe_prefix = _sanitize_prefix(prefix)
+    tmp_path = os.path.join(base_dir, f".{safe_prefix}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            sink = _DigestFile(f)
+            write(sink)
+            sink.flush()
+        if skip_unchanged:
+            latest = _latest_version_path(base_dir, safe_prefix)
+            # Comparing sizes first avoids reading the old file in the common case
+            if (latest and os.path.exists(latest) and os.path.getsize(latest) == sink.size
+                    and _file_sha256(latest) == sink.hash.digest()):
+                os.remove(tmp_path)
+                return latest, sink.size, True
+        path = get_next_version_filename(prefix)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path, sink.size, False
 
 import ast
+import base64
+import heapq
+import io
+import zlib
+from bisect import bisect_left, bisect_right
+from urllib.parse import quote, unquote, unquote_to_bytes
+import xml.etree.ElementTree as ET
+
+MXFILE_ATTRS = 'host="Electron" agent="Mozilla/5.0" version="24.7.17"'
+GRAPH_MODEL_ATTRS = 'dx="1422" dy="762" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" pageHeight="1100" math="0" shadow="0"'
+
+def xml_attr(value):
+    """Escapes a value for use inside a double-quoted XML attribute."""
+    return str(value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("\n", "&#10;")
+
+def _coord(value):
+    """Formats a coordinate without a trailing .0 and without exponent notation."""
+    if type(value) is int:
+        return str(value)
+    value = round(float(value), 2)
+    return str(int(value)) if value.is_integer() else str(value)
+
+# Characters encodeURIComponent leaves alone on top of quote()'s defaults
+_URI_COMPONENT_SAFE = "!*'()"
 
-def generate_drawio_xml(components, edges, filename_prefix="system_architecture"):
+class DeflateStream:
     """
-    Generates the Draw.io XML for a given list of components and edges.
+    Text sink producing draw.io's compressed diagram encoding incrementally:
+    base64(raw deflate(encodeURIComponent(text))), written to `out` as it goes.
+    """
+    def __init__(self, out):
+        self.out = out
+        self._compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._pending = b""
+
+    def _emit(self, final=False):
+        # base64 only encodes whole 3-byte groups without padding
+        cut = len(self._pending) if final else len(self._pending) - len(self._pending) % 3
+        if cut:
+            self.out.write(base64.b64encode(self._pending[:cut]).decode("ascii"))
+            self._pending = self._pending[cut:]
+
+    def write(self, text):
+        self._pending += self._compressor.compress(quote(text, safe=_URI_COMPONENT_SAFE).encode("ascii"))
+        self._emit()
+
+    def close(self):
+        self._pending += self._compressor.flush()
+        self._emit(final=True)
+
+def decode_diagram(text):
+    """
+    Inflates the content of a compressed <diagram> element.
+    Draw.io stores it as base64(raw deflate(encodeURIComponent(xml))).
+    """
+    data = zlib.decompress(base64.b64decode(text.strip()), -zlib.MAX_WBITS)
+    return unquote(data.decode('ascii'))
+
+def iter_decoded_diagram(text, chunk_size=1 << 16):
+    """
+    decode_diagram in pieces: yields the UTF-8 bytes of the graph model one
+    chunk at a time, so a large page is never inflated or unquoted as one string.
     """
-    print(f"DEBUG: generate_drawio_xml called with prefix={filename_prefix}, {len(components)} components")
+    data = base64.b64decode(text.strip())
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    pending = b''
+    for start in range(0, len(data), chunk_size):
+        pending += inflater.decompress(data[start:start + chunk_size])
+        # An escape cut in two by the chunk boundary waits for the next chunk
+        cut = pending.rfind(b'%', max(len(pending) - 2, 0))
+        if cut < 0:
+            cut = len(pending)
+        yield unquote_to_bytes(pending[:cut])
+        pending = pending[cut:]
+    yield unquote_to_bytes(pending + inflater.flush())
+
+class DrawioWriter:
+    """
+    Writes a draw.io document to a text stream one cell at a time.
+    Nothing but the current cell is held in memory. With indent=True the
+    output has the same layout as minidom's toprettyxml().
+    With compressed=True the graph model is deflated into the <diagram>
+    element the way draw.io saves files by default.
+    """
+    def __init__(self, out, indent=True, compressed=False):
+        self.out = out
+        self.indent = indent
+        self.compressed = compressed
+        self.vertices = 0
+        self.edges = 0
+        self._file_out = out
+        self._model_indent = indent and not compressed
+
+    def _line(self, depth, text):
+        if self.indent:
+            self.out.write("\t" * depth + text + "\n")
+        else:
+            self.out.write(text)
+
+    def _model_line(self, depth, text):
+        if self._model_indent:
+            self.out.write("\t" * depth + text + "\n")
+        else:
+            self.out.write(text)
+
+    def start(self, page_name="Page-1", page_id="demo-diagram"):
+        """Opens the document and its first page."""
+        self.start_file()
+        self.start_page(page_name, page_id)
+
+    def start_file(self):
+        self.out.write('<?xml version="1.0" ?>\n' if self.indent else '<?xml version="1.0" ?>')
+        self._line(0, f'<mxfile {MXFILE_ATTRS}>')
+
+    def start_page(self, page_name="Page-1", page_id="demo-diagram"):
+        """Opens a <diagram> page. Pages are written one after the other; only the current one is open."""
+        diagram_open = f'<diagram name="{xml_attr(page_name)}" id="{xml_attr(page_id)}">'
+        if self.compressed:
+            self.out.write(("\t" if self.indent else "") + diagram_open)
+            self.out = DeflateStream(self._file_out)
+        else:
+            self._line(1, diagram_open)
+        self._model_line(2, f'<mxGraphModel {GRAPH_MODEL_ATTRS}>')
+        self._model_line(3, '<root>')
+        self._model_line(4, '<mxCell id="0"/>')
+        self._model_line(4, '<mxCell id="1" parent="0"/>')
+
+    def vertex(self, cell_id, value, style, x, y, width, height):
+        self.vertex_xml(xml_attr(cell_id), xml_attr(value), xml_attr(style), x, y, width, height)
+
+    def vertex_xml(self, cell_id, value, style, x, y, width, height):
+        """Like vertex(), with id, value and style already escaped for XML attributes."""
+        self._model_line(4, f'<mxCell id="{cell_id}" value="{value}" style="{style}" vertex="1" parent="1">')
+        self._model_line(5, f'<mxGeometry x="{_coord(x)}" y="{_coord(y)}" width="{_coord(width)}" height="{_coord(height)}" as="geometry"/>')
+        self._model_line(4, '</mxCell>')
+        self.vertices += 1
+
+    def edge(self, cell_id, value, style, source, target, points=None):
+        self.edge_xml(xml_attr(cell_id), xml_attr(value), xml_attr(style), xml_attr(source), xml_attr(target), points)
+
+    def edge_xml(self, cell_id, value, style, source, target, points=None):
+        """Like edge(), with all attributes already escaped."""
+        self._model_line(4, f'<mxCell id="{cell_id}" value="{value}" style="{style}" edge="1" parent="1" source="{source}" target="{target}">')
+        if points:
+            self._model_line(5, '<mxGeometry relative="1" as="geometry">')
+            self._model_line(6, '<Array as="points">')
+            for x, y in points:
+                self._model_line(7, f'<mxPoint x="{_coord(x)}" y="{_coord(y)}"/>')
+            self._model_line(6, '</Array>')
+            self._model_line(5, '</mxGeometry>')
+        else:
+            self._model_line(5, '<mxGeometry relative="1" as="geometry"/>')
+        self._model_line(4, '</mxCell>')
+        self.edges += 1
+
+    def end(self):
+        """Closes the current page and the document."""
+        self.end_page()
+        self.end_file()
+
+    def end_page(self):
+        self._model_line(3, '</root>')
+        self._model_line(2, '</mxGraphModel>')
+        if self.compressed:
+            self.out.close()
+            self.out = self._file_out
+            self.out.write('</diagram>\n' if self.indent else '</diagram>')
+        else:
+            self._line(1, '</diagram>')
+
+    def end_file(self):
+        self._line(0, '</mxfile>')
+
+def _parse_item(item):
+    """Accepts a dict, or a dict serialized as JSON or as a Python literal (models sometimes send those)."""
+    if not isinstance(item, str):
+        return item
     try:
-        print(f"DEBUG Components dump: {json.dumps(components)}")
-    except:
-        print(f"DEBUG Components dump (raw): {components}")
-    library = {item["id"]: item for item in load_library()}
-
-
-    
-    # Basic XML skeleton
-    xml_start = '<mxfile host="Electron" agent="Mozilla/5.0" version="24.7.17"><diagram name="Page-1" id="demo-diagram"><mxGraphModel dx="1422" dy="762" grid="1" gridSize="10" guides="1" tooltips="1" connect="1" arrows="1" fold="1" page="1" pageScale="1" pageWidth="850" pageHeight="1100" math="0" shadow="0"><root><mxCell id="0"/><mxCell id="1" parent="0"/>'
-    xml_end = '</root></mxGraphModel></diagram></mxfile>'
-    
-    content_xml = ""
-    
-    # --- Pre-processing: Parse all components into dicts ---
-    parsed_components = []
-    for i, comp in enumerate(components):
-        if isinstance(comp, str):
-            try:
-                comp = json.loads(comp)
-            except:
-                try:
-                    comp = ast.literal_eval(comp)
-                except:
-                    print(f"Warning: Failed to parse component string: {comp[:50]}")
-                    continue
-        if isinstance(comp, dict):
-            parsed_components.append(comp)
-
-    # Create a map for coordinate lookup (Pre-populated)
-    comp_data_map = {str(comp.get('id', f"node_{i}")): comp for i, comp in enumerate(parsed_components)}
-    
-    # Keep track of generated XML IDs
-    node_id_map = {}
-    
-    for i, comp in enumerate(parsed_components):
-        lib_id = comp.get('library_id')
-        lib_item = library.get(lib_id)
+        return json.loads(item)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(item)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+class Component:
+    """
+    One validated component. Geometry is numeric (x and y are None until laid
+    out), and the label and style are already escaped for XML attributes.
+    """
+    __slots__ = ("id", "cell_id", "library_id", "role", "external", "x", "y", "width", "height",
+                 "label_xml", "style_xml")
+
+    def __init__(self, uid, lib_item, role, x, y, width, height, external, label_xml, style_xml):
+        self.id = uid
+        self.cell_id = node_cell_id(uid)
+        self.library_id = lib_item['id']
+        self.role = role
+        self.external = external
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.label_xml = label_xml
+        self.style_xml = style_xml
+
+    @property
+    def positioned(self):
+        return self.x is not None and self.y is not None
+
+    def box(self):
+        return (self.x, self.y, self.x + self.width, self.y + self.height)
+
+class Edge:
+    """
+    One validated edge between two known component ids. points holds the
+    waypoints the layout drew it through, or None.
+    """
+    __slots__ = ("source", "target", "key", "label_xml", "points")
+
+    def __init__(self, source, target, key, label_xml):
+        self.source = source
+        self.target = target
+        self.key = key
+        self.label_xml = label_xml
+        self.points = None
+
+def _spec_error(kind, index, message, uid=None):
+    return {"kind": kind, "index": index, "id": uid, "error": message}
+
+def _number(value):
+    """
+    Numbers are kept as they are (ints stay ints for compact output); strings are
+    converted. NaN and infinities raise ValueError like any other non-number.
+    """
+    if value is None or type(value) is int:
+        return value
+    number = value if type(value) is float else float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"{value!r} is not finite")
+    return number
+
+def _flag(value):
+    """Spec booleans may arrive as strings: 'false', '0', 'no' and '' are False."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def build_diagram_model(components, edges, library):
+    """
+    Validates component and edge specs in one pass and converts them into
+    Component and Edge records. Returns (components, edges, errors); each error
+    is a dict with kind ('component' or 'edge'), index in the input list, id
+    and an error message. Invalid items are left out of the model:
+    unparseable specs, unknown library ids, non-numeric geometry, repeated
+    component ids and edges whose endpoints are not components.
+    """
+    errors = []
+    records = []
+    by_id = {}
+    # Styles and roles are shared by every component using the same library item
+    library_cache = {}
+    for i, spec in enumerate(components):
+        spec = _parse_item(spec)
+        if not isinstance(spec, dict):
+            errors.append(_spec_error("component", i, "not a dict"))
+            continue
+        uid = str(spec.get('id', f"node_{i}"))
+        if uid in by_id:
+            errors.append(_spec_error("component", i, "duplicate id", uid))
+            continue
+        lib_item = library.get(spec.get('library_id'))
         if not lib_item:
+            errors.append(_spec_error("component", i, f"unknown library_id {spec.get('library_id')!r}", uid))
+            continue
+        cached = library_cache.get(lib_item['id'])
+        if cached is None:
+            role = lib_item.get('category') or component_role(lib_item['style'])
+            cached = library_cache[lib_item['id']] = (role, xml_attr(lib_item['style']))
+        try:
+            x = _number(spec.get('x'))
+            y = _number(spec.get('y'))
+            width = _number(spec.get('width'))
+            height = _number(spec.get('height'))
+        except (TypeError, ValueError):
+            errors.append(_spec_error("component", i, "geometry is not numeric", uid))
+            continue
+        if width is None:
+            width = lib_item['width']
+        if height is None:
+            height = lib_item['height']
+        label = spec.get('label', lib_item['value'])
+        comp = Component(uid, lib_item, cached[0], x, y, width, height, _flag(spec.get('external')),
+                         xml_attr(label), cached[1])
+        by_id[uid] = comp
+        records.append(comp)
+
+    edge_records = []
+    for i, spec in enumerate(edges):
+        spec = _parse_item(spec)
+        if not isinstance(spec, dict):
+            errors.append(_spec_error("edge", i, "not a dict"))
+            continue
+        source = str(spec.get('source') or spec.get('source_id') or "")
+        target = str(spec.get('target') or spec.get('target_id') or "")
+        key = edge_key(spec)
+        missing = [uid for uid in (source, target) if uid not in by_id]
+        if missing:
+            errors.append(_spec_error("edge", i, f"unknown endpoint {missing[0]!r}", key))
+            continue
+        edge_records.append(Edge(source, target, key, xml_attr(spec.get('label', ''))))
+    return records, edge_records, errors
+
+def _port_style(sx, sy, tx, ty):
+    """Dynamic port selection based on the relative position of two components' top-left corners."""
+    dx = tx - sx
+    dy = ty - sy
+
+    # Logic: Determine primary direction
+    if abs(dy) > abs(dx) and dy > 0:
+        # Target is clearly BELOW Source
+        # Exit Bottom (0.5, 1) -> Entry Top (0.5, 0)
+        return "exitX=0.5;exitY=1;entryX=0.5;entryY=0;"
+    elif abs(dy) > abs(dx) and dy < 0:
+        # Target is ABOVE Source
+        return "exitX=0.5;exitY=0;entryX=0.5;entryY=1;"
+    elif dx > 0:
+        # Target is RIGHT of Source
+        return "exitX=1;exitY=0.5;entryX=0;entryY=0.5;"
+    # Target is LEFT of Source
+    return "exitX=0;exitY=0.5;entryX=1;entryY=0.5;"
+
+def _waypoint_ports(source, first, target, last):
+    """Ports for an edge with waypoints: the sides facing its first and last waypoint."""
+    def port(comp, point):
+        dx = point[0] - (comp.x + comp.width / 2)
+        dy = point[1] - (comp.y + comp.height / 2)
+        if abs(dx) >= abs(dy):
+            return (1 if dx > 0 else 0), 0.5
+        return 0.5, (1 if dy > 0 else 0)
+    exit_x, exit_y = port(source, first)
+    entry_x, entry_y = port(target, last)
+    return f"exitX={exit_x:g};exitY={exit_y:g};entryX={entry_x:g};entryY={entry_y:g};"
+
+LAYOUT_ORIGIN = (50, 50)
+LAYOUT_COLUMN_GAP = 100
+LAYOUT_ROW_GAP = 60
+LAYOUT_STACK_GAP = 40
+LAYOUT_PADDING = 60
+LAYOUT_SWEEPS = 2
+# Columns hold at most max(LAYOUT_MIN_LAYER_WIDTH, sqrt(n)) of the n laid-out components
+LAYOUT_MIN_LAYER_WIDTH = 8
+# Vertical room around the channel a long edge takes through a column
+LAYOUT_CHANNEL_GAP = 20
+# Columns an edge may cross through channels; longer edges run along a lane
+# above or below the columns instead
+LAYOUT_MAX_CHANNELS = 2
+
+def _layer_nodes(nodes, succ):
+    """
+    Longest-path layering. Back edges found by an iterative DFS are ignored,
+    which breaks cycles. Returns {uid: layer}, layers starting at 0.
+    """
+    state = {}  # 1 = on stack, 2 = done
+    order = []
+    for root in nodes:
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(succ[root]))]
+        while stack:
+            uid, children = stack[-1]
+            for child in children:
+                if child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(succ[child])))
+                    break
+            else:
+                state[uid] = 2
+                order.append(uid)
+                stack.pop()
+    layer = {uid: 0 for uid in nodes}
+    # Reverse DFS finish order is a topological order of the forward edges
+    position = {uid: i for i, uid in enumerate(reversed(order))}
+    for uid in reversed(order):
+        for child in succ[uid]:
+            if position[child] > position[uid] and layer[child] < layer[uid] + 1:
+                layer[child] = layer[uid] + 1
+    return layer
+
+def _bound_layers(nodes, succ, layer, width):
+    """
+    Caps every layer at `width` nodes, Coffman-Graham style: each node goes to
+    the first layer after all of its predecessors that still has room. Nodes
+    are taken depth first in topological order, so a tree fills a band of
+    adjacent layers instead of every source crowding the first ones and pushing
+    its successors far behind. Edges not pointing to a later `layer` are
+    ignored, as _layer_nodes did. Returns {uid: layer}.
+    """
+    forward = {uid: [child for child in succ[uid] if layer[child] > layer[uid]] for uid in nodes}
+    pending = dict.fromkeys(nodes, 0)
+    for uid in nodes:
+        for child in forward[uid]:
+            pending[child] += 1
+    earliest = dict.fromkeys(nodes, 0)
+    stack = [uid for uid in reversed(nodes) if not pending[uid]]
+    bounded = {}
+    filled = []
+    jump = {}  # full layer -> a later layer that may have room
+    while stack:
+        uid = stack.pop()
+        at = earliest[uid]
+        path = []
+        while at < len(filled) and filled[at] >= width:
+            path.append(at)
+            at = jump.get(at, at + 1)
+        for full in path:
+            jump[full] = at
+        while at >= len(filled):
+            filled.append(0)
+        filled[at] += 1
+        bounded[uid] = at
+        for child in reversed(forward[uid]):
+            earliest[child] = max(earliest[child], at + 1)
+            pending[child] -= 1
+            if not pending[child]:
+                stack.append(child)
+    return bounded
+
+def _assign_layers(nodes, succ, width):
+    """
+    Layers for the internal columns. Longest paths are taken both from the
+    sources and from the sinks, and the layering whose edges span fewer layers
+    wins: fan-outs lay out well from the sources, in-trees from the sinks, and
+    every layer crossed is a dummy node later. Layers are then capped at
+    `width`, working from the same end.
+    """
+    preds = {uid: [] for uid in nodes}
+    for uid in nodes:
+        for child in succ[uid]:
+            preds[child].append(uid)
+    from_sources = _layer_nodes(nodes, succ)
+    from_sinks = _layer_nodes(nodes, preds)
+    def span(layer):
+        return sum(abs(layer[child] - layer[uid]) for uid in nodes for child in succ[uid])
+    if span(from_sources) <= span(from_sinks):
+        return _bound_layers(nodes, succ, from_sources, width)
+    bounded = _bound_layers(nodes, preds, from_sinks, width)
+    last = max(bounded.values(), default=0)
+    return {uid: last - layer for uid, layer in bounded.items()}
+
+def _order_columns(columns, neighbors):
+    """Barycenter crossing reduction: alternating left-to-right and right-to-left sweeps."""
+    index = {}
+    for column in columns:
+        for i, uid in enumerate(column):
+            index[uid] = i
+    column_of = {uid: c for c, column in enumerate(columns) for uid in column}
+
+    def sweep(column_range, before):
+        for c in column_range:
+            column = columns[c]
+            def key(uid):
+                ranks = [index[n] for n in neighbors[uid] if before(column_of[n], c)]
+                return sum(ranks) / len(ranks) if ranks else index[uid]
+            column.sort(key=key)
+            for i, uid in enumerate(column):
+                index[uid] = i
+
+    for _ in range(LAYOUT_SWEEPS):
+        sweep(range(1, len(columns)), lambda other, c: other < c)
+        sweep(range(len(columns) - 2, -1, -1), lambda other, c: other > c)
+
+def layout_components(components, edges):
+    """
+    Assigns x/y to the components that have none, using a layered (Sugiyama-style)
+    layout: internal components flow left to right in columns inside the system
+    boundary, actors get columns left of it, components with external=True
+    columns right of it, and each database is stacked below the service it is
+    connected to. Columns hold at most max(LAYOUT_MIN_LAYER_WIDTH, sqrt(V))
+    components (see _bound_layers). Every laid-out edge gets orthogonal
+    waypoints that clear the other components: an edge crossing up to
+    LAYOUT_MAX_CHANNELS columns gets a dummy node in each, ordered with the
+    components as a free channel; a longer edge leaves through the gap next to
+    its source's column, runs along a lane above or below all columns and comes
+    back down the gap next to its target's. A boundary or title without
+    coordinates is sized and placed around the internal columns. Components
+    that already have coordinates are left alone. Runs in O((V + E) log V).
+    Takes Component and Edge records (see build_diagram_model) and sets their
+    x/y and Edge.points.
+    """
+    info = {comp.id: (comp, comp.role, comp.width, comp.height) for comp in components}
+
+    free = [comp.id for comp in components if not comp.positioned]
+    if not free:
+        return
+    free_set = set(free)
+    boundary = next((uid for uid in free if info[uid][1] == 'boundary'), None)
+    title = next((uid for uid in free if info[uid][1] == 'title'), None)
+
+    # The boundary and title are fitted around the rest, so their edges are not laid out
+    links = [edge for edge in edges
+             if edge.source != edge.target and edge.source in free_set and edge.target in free_set
+             and info[edge.source][1] not in ('boundary', 'title') and info[edge.target][1] not in ('boundary', 'title')]
+
+    # Databases hang below the first service they are connected to
+    parent_of = {}
+    attached = {}
+    for edge in links:
+        for db, service in ((edge.target, edge.source), (edge.source, edge.target)):
+            if info[db][1] == 'database' and db not in parent_of and info[service][1] in ('container', 'queue'):
+                parent_of[db] = service
+                attached.setdefault(service, []).append(db)
+    def rep(uid):
+        return parent_of.get(uid, uid)
+
+    placed = [uid for uid in free if info[uid][1] not in ('boundary', 'title') and uid not in parent_of]
+    def side(uid):
+        comp, role, _, _ = info[uid]
+        if role == 'actor':
+            return 'left'
+        if comp.external:
+            return 'right'
+        return 'inside'
+    internal = [uid for uid in placed if side(uid) == 'inside']
+
+    succ = {uid: [] for uid in placed}
+    for edge in links:
+        source, target = rep(edge.source), rep(edge.target)
+        if source != target and side(source) == side(target) == 'inside':
+            succ[source].append(target)
+
+    width = max(LAYOUT_MIN_LAYER_WIDTH, math.ceil(math.sqrt(len(placed))))
+    layer = _assign_layers(internal, succ, width)
+    depth = max(layer.values(), default=-1) + 1
+    columns = [[] for _ in range(depth)]
+    for uid in internal:
+        columns[layer[uid]].append(uid)
+    # Actors and external systems wrap into further columns of the same height
+    def wrap(uids):
+        return [uids[i:i + width] for i in range(0, len(uids), width)]
+    left = wrap([uid for uid in placed if side(uid) == 'left'])
+    right = wrap([uid for uid in placed if side(uid) == 'right'])
+    all_columns = left + columns + right
+    column_of = {uid: c for c, column in enumerate(all_columns) for uid in column}
+
+    # Edges crossing a few columns, actors and external systems included, are
+    # chained through one dummy node, keyed (edge, column), per column they cross
+    neighbors = {uid: set() for uid in placed}
+    chains = []
+    lanes = []
+    for edge in links:
+        source, target = rep(edge.source), rep(edge.target)
+        if source == target:
+            continue
+        first, last = column_of[source], column_of[target]
+        if abs(last - first) > LAYOUT_MAX_CHANNELS + 1:
+            neighbors[source].add(target)
+            neighbors[target].add(source)
+            lanes.append((edge, first, last))
+            continue
+        step = 1 if last > first else -1
+        chain = [source]
+        for c in range(first + step, last, step):
+            dummy = (edge, c)
+            all_columns[c].append(dummy)
+            neighbors[dummy] = set()
+            chain.append(dummy)
+        chain.append(target)
+        for a, b in zip(chain, chain[1:]):
+            neighbors[a].add(b)
+            neighbors[b].add(a)
+        chains.append((edge, chain))
+    _order_columns(all_columns, neighbors)
+
+    def slot_size(uid):
+        if uid not in info:
+            return 0, 0
+        _, _, width, height = info[uid]
+        dbs = attached.get(uid, [])
+        if dbs:
+            row_width = sum(info[db][2] for db in dbs) + LAYOUT_ROW_GAP * (len(dbs) - 1)
+            width = max(width, row_width)
+            height += LAYOUT_STACK_GAP + max(info[db][3] for db in dbs)
+        return width, height
+
+    def gaps(column):
+        """The vertical gap after each slot but the last; channels only need LAYOUT_CHANNEL_GAP."""
+        return [LAYOUT_CHANNEL_GAP if a not in info or b not in info else LAYOUT_ROW_GAP
+                for a, b in zip(column, column[1:])]
+
+    def measure(column):
+        sizes = [slot_size(uid) for uid in column]
+        width = max((w for w, _ in sizes), default=0)
+        height = sum(h for _, h in sizes) + sum(gaps(column))
+        return sizes, width, height
+
+    measured = [measure(column) for column in all_columns]
+    content_height = max((height for _, _, height in measured), default=0)
+
+    spans = [None] * len(all_columns)
+    channel_y = {}
+    def place_column(c, col_x, top):
+        column = all_columns[c]
+        sizes, col_width, _ = measured[c]
+        spans[c] = (col_x, col_x + col_width)
+        y = top
+        for uid, (slot_width, slot_height), gap in zip(column, sizes, gaps(column) + [0]):
+            if uid not in info:
+                channel_y[uid] = y
+                y += gap
+                continue
+            comp, _, width, height = info[uid]
+            comp.x = round(col_x + (col_width - width) / 2)
+            comp.y = round(y)
+            dbs = attached.get(uid, [])
+            if dbs:
+                row_width = sum(info[db][2] for db in dbs) + LAYOUT_ROW_GAP * (len(dbs) - 1)
+                db_x = col_x + (col_width - row_width) / 2
+                for db in dbs:
+                    db_comp, _, db_width, _ = info[db]
+                    db_comp.x = round(db_x)
+                    db_comp.y = round(y + height + LAYOUT_STACK_GAP)
+                    db_x += db_width + LAYOUT_ROW_GAP
+            y += slot_height + gap
+
+    origin_x, origin_y = LAYOUT_ORIGIN
+    title_height = info[title][3] + LAYOUT_PADDING / 2 if title else 0
+    content_top = origin_y + LAYOUT_PADDING + title_height
+    middle = content_top + content_height / 2
+
+    def place_columns(first, last, x):
+        """Places columns first..last-1 side by side from x; returns the x after the last gap."""
+        for c in range(first, last):
+            _, col_width, col_height = measured[c]
+            place_column(c, x, middle - col_height / 2)
+            x += col_width + LAYOUT_COLUMN_GAP
+        return x
+
+    # Actors, left of the boundary
+    boundary_x = place_columns(0, len(left), origin_x)
+
+    # Internal tiers
+    inside_end = len(left) + depth
+    x = place_columns(len(left), inside_end, boundary_x + LAYOUT_PADDING)
+    inner_right = x - LAYOUT_COLUMN_GAP if columns else x
+    boundary_width = max(inner_right + LAYOUT_PADDING - boundary_x, info[title][2] + 2 * LAYOUT_PADDING if title else 0)
+
+    # External systems, right of the boundary
+    place_columns(inside_end, len(all_columns), boundary_x + boundary_width + LAYOUT_COLUMN_GAP)
+
+    def approach(uid):
+        """Where an edge meets a component, and the level it runs at through the component's column."""
+        comp = info[uid][0]
+        centre = (comp.x + comp.width / 2, comp.y + comp.height / 2)
+        if uid not in parent_of:
+            return [centre], centre[1]
+        # A database is reached from the gap between its service and the database row
+        level = comp.y - LAYOUT_STACK_GAP / 2
+        return [centre, (round(centre[0]), round(level))], level
+
+    # Edges run level through each column they cross, at the source, along a
+    # channel or at the target, and change level halfway across the gaps between
+    # columns; an edge within one column goes round through the gap on its right
+    for edge, chain in chains:
+        head, start_level = approach(edge.source)
+        tail, end_level = approach(edge.target)
+        levels = [start_level] + [channel_y[dummy] for dummy in chain[1:-1]] + [end_level]
+        cols = [column_of[uid] if uid in info else uid[1] for uid in chain]
+        points = head
+        for (a, b), (y0, y1) in zip(zip(cols, cols[1:]), zip(levels, levels[1:])):
+            if a < b:
+                x = (spans[a][1] + spans[b][0]) / 2
+            elif a > b:
+                x = (spans[b][1] + spans[a][0]) / 2
+            else:
+                x = spans[a][1] + LAYOUT_COLUMN_GAP / 2
+            points += [(round(x), round(y0)), (round(x), round(y1))]
+        points = _simplify(points + tail[::-1])[1:-1]
+        edge.points = points or None
+
+    # Longer edges take the nearer of two lanes, in the padding above and below the columns
+    lane_y = (content_top - LAYOUT_PADDING / 2, content_top + content_height + LAYOUT_PADDING / 2)
+    for edge, first, last in lanes:
+        head, start_level = approach(edge.source)
+        tail, end_level = approach(edge.target)
+        step = 1 if last > first else -1
+        out_x = (spans[first][1] + spans[first + 1][0]) / 2 if step > 0 else (spans[first - 1][1] + spans[first][0]) / 2
+        in_x = (spans[last - 1][1] + spans[last][0]) / 2 if step > 0 else (spans[last][1] + spans[last + 1][0]) / 2
+        lane = lane_y[start_level + end_level > 2 * middle]
+        points = head + [(round(out_x), round(start_level)), (round(out_x), round(lane)),
+                         (round(in_x), round(lane)), (round(in_x), round(end_level))]
+        edge.points = _simplify(points + tail[::-1])[1:-1]
+
+    if boundary:
+        comp = info[boundary][0]
+        comp.x, comp.y = round(boundary_x), round(origin_y)
+        comp.width = round(boundary_width)
+        comp.height = round(content_top + content_height + LAYOUT_PADDING - origin_y)
+    if title:
+        comp, _, width, _ = info[title]
+        comp.x = round(boundary_x + (boundary_width - width) / 2)
+        comp.y = round(origin_y + LAYOUT_PADDING / 2)
+
+NUDGE_GAP = 20
+# Blockers reported per edge; the line-of-sight walk stops once it has found these
+MAX_BLOCKERS = 3
+
+class SpatialGrid:
+    """
+    Uniform grid index over axis-aligned rectangles (x0, y0, x1, y1).
+    Each rectangle is registered in every cell it covers, so a query only looks
+    at the rectangles sharing a cell with the query box.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = max(float(cell_size), 1.0)
+        self.cells = {}
+        self.rects = {}
+
+    def _cell_range(self, rect):
+        size = self.cell_size
+        x0, y0, x1, y1 = rect
+        for cx in range(int(x0 // size), int(x1 // size) + 1):
+            for cy in range(int(y0 // size), int(y1 // size) + 1):
+                yield (cx, cy)
+
+    def insert(self, key, rect):
+        self.rects[key] = rect
+        for cell in self._cell_range(rect):
+            self.cells.setdefault(cell, []).append(key)
+
+    def remove(self, key):
+        rect = self.rects.pop(key)
+        for cell in self._cell_range(rect):
+            self.cells[cell].remove(key)
+
+    def candidates(self, rect):
+        found = set()
+        for cell in self._cell_range(rect):
+            found.update(self.cells.get(cell, ()))
+        return found
+
+    def query(self, rect):
+        """Keys whose rectangles overlap `rect` (touching edges do not count)."""
+        return [key for key in self.candidates(rect)
+                if _rects_overlap(self.rects[key], rect)]
+
+    def _segment_cells(self, x0, y0, x1, y1):
+        """Cells crossed by a segment, walked in order (Amanatides-Woo)."""
+        size = self.cell_size
+        cx, cy = int(x0 // size), int(y0 // size)
+        end_x, end_y = int(x1 // size), int(y1 // size)
+        dx, dy = x1 - x0, y1 - y0
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+        t_max_x = ((cx + (step_x > 0)) * size - x0) / dx if dx else float('inf')
+        t_max_y = ((cy + (step_y > 0)) * size - y0) / dy if dy else float('inf')
+        t_delta_x = size / abs(dx) if dx else float('inf')
+        t_delta_y = size / abs(dy) if dy else float('inf')
+        yield (cx, cy)
+        for _ in range(abs(end_x - cx) + abs(end_y - cy)):
+            if t_max_x < t_max_y:
+                cx += step_x
+                t_max_x += t_delta_x
+            else:
+                cy += step_y
+                t_max_y += t_delta_y
+            yield (cx, cy)
+
+    def query_segment(self, x0, y0, x1, y1, ignore=(), limit=None):
+        """
+        Keys whose rectangles the segment passes through, in the order the segment
+        reaches their cells. Each candidate is clipped once however many cells it
+        shares with the segment; keys in `ignore` are skipped, and the walk stops
+        after `limit` hits, so a blocked long segment costs only up to its first hits.
+        """
+        seen = set(ignore)
+        hits = []
+        rects = self.rects
+        cells = self.cells
+        if x0 != x1 and y0 != y1:
+            for cell in self._segment_cells(x0, y0, x1, y1):
+                for key in cells.get(cell, ()):
+                    if key not in seen:
+                        seen.add(key)
+                        if _segment_hits_rect(x0, y0, x1, y1, rects[key]):
+                            hits.append(key)
+                            if limit and len(hits) >= limit:
+                                return hits
+            return hits
+        # Orthogonal segments, most of those a layout draws, walk one row or
+        # column of cells and are a box test
+        size = self.cell_size
+        left, top, right, bottom = min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+        if y0 == y1:
+            row = int(y0 // size)
+            first, last = int(x0 // size), int(x1 // size)
+            step = 1 if last >= first else -1
+            walk = [(c, row) for c in range(first, last + step, step)]
+        else:
+            column = int(x0 // size)
+            first, last = int(y0 // size), int(y1 // size)
+            step = 1 if last >= first else -1
+            walk = [(column, c) for c in range(first, last + step, step)]
+        for cell in walk:
+            keys = cells.get(cell)
+            if not keys:
+                continue
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                rect = rects[key]
+                if rect[0] < right and left < rect[2] and rect[1] < bottom and top < rect[3]:
+                    hits.append(key)
+                    if limit and len(hits) >= limit:
+                        return hits
+        return hits
+
+def _rects_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def _rect_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+def _crosses_boundary(boundary, box):
+    """
+    The boundary rule used by generation and patching alike: a component fully
+    inside the boundary is internal, one fully outside it is external (as the
+    agent places external systems right of the boundary), and one straddling
+    the boundary's edge is misplaced.
+    """
+    return _rects_overlap(boundary, box) and not _rect_contains(boundary, box)
+
+def _segment_hits_rect(x0, y0, x1, y1, rect):
+    """Liang-Barsky clipping: does the segment cross the rectangle's interior?"""
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0 - rect[0]), (dx, rect[2] - x0), (-dy, y0 - rect[1]), (dy, rect[3] - y0)):
+        if p == 0:
+            if q <= 0:
+                return False
             continue
-            
-        new_id = f"node-{uuid.uuid4()}"
-        user_id = str(comp.get('id', f"node_{i}"))
-        node_id_map[user_id] = new_id
-        
-        # Override value if provided
-        value = comp.get('label', lib_item['value'])
-        # Escape XML entities in value
-        value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&apos;")
-        
-        style = lib_item['style']
-        width = comp.get('width', lib_item['width'])
-        height = comp.get('height', lib_item['height'])
-        x = comp.get('x', 0)
-        y = comp.get('y', 0)
-        
-        content_xml += f'<mxCell id="{new_id}" value="{value}" style="{style}" vertex="1" parent="1"><mxGeometry x="{x}" y="{y}" width="{width}" height="{height}" as="geometry"/></mxCell>'
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 >= t1:
+            return False
+    return True
+
+def _vertex_boxes(components):
+    """
+    Returns ({uid: (x0, y0, x1, y1)}, {uid: role}, {uid: component}) for every
+    positioned component.
+    """
+    boxes = {}
+    roles = {}
+    comps = {}
+    for comp in components:
+        if comp.positioned:
+            boxes[comp.id] = comp.box()
+            roles[comp.id] = comp.role
+            comps[comp.id] = comp
+    return boxes, roles, comps
+
+def _grid_cell_size(boxes, skip=()):
+    sizes = [max(b[2] - b[0], b[3] - b[1]) for uid, b in boxes.items() if uid not in skip]
+    return 2 * sum(sizes) / len(sizes) if sizes else 100
 
+def validate_layout(components, edges, fix=False):
+    """
+    Checks component geometry with a SpatialGrid:
+      - overlaps: pairs of vertices whose boxes intersect (boundary excluded),
+      - outside_boundary: components straddling the 'System Boundary' (see
+        _crosses_boundary; actors, titles and external=True components are exempt),
+      - blocked_edges: edges whose straight line, or path through the waypoints
+        the layout gave them, passes through another vertex, listing up to
+        MAX_BLOCKERS of the blockers nearest the source.
+    With fix=True, straddling components are first moved into the boundary, overlaps
+    are resolved by pushing vertices down, and the boundary grows to fit its
+    members; components fully outside it are left where they are. The Component
+    records are updated in place and the report describes the fixed layout.
+    Blocked edges are only reported. Each edge's line of sight is walked cell by
+    cell and stops at MAX_BLOCKERS hits, so the pass costs about the total edge
+    length in grid cells; roughly O(n log n) for evenly sized shapes.
+    """
+    boxes, roles, comps = _vertex_boxes(components)
+
+    boundary = next((uid for uid in boxes if roles[uid] == 'boundary'), None)
+    vertices = [uid for uid in boxes if roles[uid] != 'boundary']
+    titles = {uid for uid in vertices if roles[uid] == 'title'}
+    checked = [uid for uid in vertices
+               if boundary and roles[uid] not in ('actor', 'title') and not comps[uid].external]
+    # Components touching the boundary belong in it; the ones fully outside are external
+    internal = [uid for uid in checked if _rects_overlap(boxes[boundary], boxes[uid])]
+
+    def move(uid, x, y):
+        x0, y0, x1, y1 = boxes[uid]
+        boxes[uid] = (x, y, x + x1 - x0, y + y1 - y0)
+        comps[uid].x, comps[uid].y = round(x), round(y)
+
+    if fix and boundary:
+        bx0, by0, bx1, by1 = boxes[boundary]
+        for uid in internal:
+            x0, y0, x1, y1 = boxes[uid]
+            x = min(max(x0, bx0 + NUDGE_GAP), bx1 - NUDGE_GAP - (x1 - x0))
+            y = min(max(y0, by0 + NUDGE_GAP), by1 - NUDGE_GAP - (y1 - y0))
+            if (x, y) != (x0, y0):
+                move(uid, max(x, bx0), max(y, by0))
+
+    grid = SpatialGrid(_grid_cell_size(boxes, skip=(boundary,)))
+
+    overlaps = []
+    for uid in sorted(vertices, key=lambda u: (boxes[u][1], boxes[u][0])):
+        hits = grid.query(boxes[uid])
+        if hits and fix:
+            while hits:
+                x0, y0, _, _ = boxes[uid]
+                move(uid, x0, max(grid.rects[h][3] for h in hits) + NUDGE_GAP)
+                hits = grid.query(boxes[uid])
+        overlaps.extend((hit, uid) for hit in hits)
+        grid.insert(uid, boxes[uid])
+
+    if fix and boundary and internal:
+        bx0, by0, bx1, by1 = boxes[boundary]
+        bx1 = max(bx1, max(boxes[uid][2] for uid in internal) + NUDGE_GAP)
+        by1 = max(by1, max(boxes[uid][3] for uid in internal) + NUDGE_GAP)
+        boxes[boundary] = (bx0, by0, bx1, by1)
+        comps[boundary].width, comps[boundary].height = round(bx1 - bx0), round(by1 - by0)
+
+    outside = [uid for uid in checked if _crosses_boundary(boxes[boundary], boxes[uid])]
+
+    blocked = []
     for edge in edges:
-        # Robust parsing: Handle stringified JSON
-        if isinstance(edge, str):
-            try:
-                edge_str = edge
-                edge = json.loads(edge)
-                print(f"DEBUG: Parsed edge string (JSON): {edge}")
-            except:
-                try:
-                    edge = ast.literal_eval(edge_str)
-                    print(f"DEBUG: Parsed edge string (AST): {edge}")
-                except Exception as e:
-                    print(f"Warning: Failed to parse edge string: {edge_str[:50]}... Error: {e}")
+        source, target = edge.source, edge.target
+        if source not in grid.rects or target not in grid.rects:
+            continue
+        sx0, sy0, sx1, sy1 = boxes[source]
+        tx0, ty0, tx1, ty1 = boxes[target]
+        path = [((sx0 + sx1) / 2, (sy0 + sy1) / 2), *(edge.points or ()), ((tx0 + tx1) / 2, (ty0 + ty1) / 2)]
+        hits = []
+        for (ax, ay), (bx, by) in zip(path, path[1:]):
+            hits += grid.query_segment(ax, ay, bx, by, titles.union((source, target), hits),
+                                       limit=MAX_BLOCKERS - len(hits))
+            if len(hits) >= MAX_BLOCKERS:
+                break
+        blockers = sorted(hits)
+        if blockers:
+            blocked.append({"source": source, "target": target, "blockers": blockers})
+
+    return {"overlaps": overlaps, "outside_boundary": outside, "blocked_edges": blocked}
+
+def _report_issues(report):
+    counts = {name: len(found) for name, found in report.items() if found}
+    if counts:
+        print("Warning: layout issues " + ", ".join(f"{name}={n}" for name, n in counts.items()))
+
+ROUTE_STUB = 20
+ROUTE_CLEARANCE = 10
+ROUTE_BEND_PENALTY = 40
+ROUTE_MARGIN = 60
+ROUTE_ATTEMPTS = 4
+# Edges whose search window is larger than this keep draw.io's default routing
+ROUTE_MAX_OBSTACLES = 150
+ROUTE_MAX_WINDOW_CELLS = 4096
+
+_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+def _port_point(box, fx, fy):
+    """Point on a box for draw.io's relative port coordinates, plus its outward direction."""
+    x0, y0, x1, y1 = box
+    point = (x0 + fx * (x1 - x0), y0 + fy * (y1 - y0))
+    if fx >= 1:
+        return point, (1, 0)
+    if fx <= 0:
+        return point, (-1, 0)
+    return point, (0, 1) if fy >= 1 else (0, -1)
+
+_port_fraction_cache = {}
+
+def _port_fractions(port_style):
+    """(exitX, exitY, entryX, entryY) of a port style; there are only a handful, so they are cached."""
+    fractions = _port_fraction_cache.get(port_style)
+    if fractions is None:
+        styles = _style_map(port_style)
+        fractions = _port_fraction_cache[port_style] = tuple(float(styles[key]) for key in ('exitX', 'exitY', 'entryX', 'entryY'))
+    return fractions
+
+def _simplify(points):
+    """Drops repeated and collinear points from an orthogonal polyline."""
+    result = []
+    for point in points:
+        if result and point == result[-1]:
+            continue
+        if len(result) >= 2:
+            (ax, ay), (bx, by) = result[-2], result[-1]
+            if (ax == bx == point[0]) or (ay == by == point[1]):
+                result[-1] = point
+                continue
+        result.append(point)
+    return result
+
+class EdgeRouter:
+    """
+    Orthogonal edge routing around vertex boxes.
+    An edge keeps draw.io's default routing (no waypoints) when that path is clear.
+    Otherwise an A* search runs on a local orthogonal visibility grid, built from
+    the padded boxes that a SpatialGrid query finds around the two endpoints, and
+    the resulting bends are returned as waypoints.
+    """
+    def __init__(self, boxes, obstacles, cell_size=None):
+        self.boxes = boxes
+        self.grid = SpatialGrid(cell_size or _grid_cell_size(boxes))
+        for uid in obstacles:
+            self.grid.insert(uid, boxes[uid])
+
+    @staticmethod
+    def _ports(source_box, target_box, port_style):
+        exit_x, exit_y, entry_x, entry_y = _port_fractions(port_style)
+        start, out_dir = _port_point(source_box, exit_x, exit_y)
+        end, in_dir = _port_point(target_box, entry_x, entry_y)
+        return start, out_dir, end, in_dir
+
+    @staticmethod
+    def _candidates(start, out_dir, end):
+        """The path orthogonalEdgeStyle would draw, a Z through the midpoint, then the two single-bend paths."""
+        if out_dir[0]:
+            mid = (start[0] + end[0]) / 2
+            default = [start, (mid, start[1]), (mid, end[1]), end]
+        else:
+            mid = (start[1] + end[1]) / 2
+            default = [start, (start[0], mid), (end[0], mid), end]
+        return [default] + [[start, corner, end] for corner in ((end[0], start[1]), (start[0], end[1]))]
+
+    @staticmethod
+    def _windows(start, out_dir, end, in_dir):
+        """(stub_start, stub_end, window) for each search attempt, the margin doubling each time."""
+        stub_start = (start[0] + out_dir[0] * ROUTE_STUB, start[1] + out_dir[1] * ROUTE_STUB)
+        stub_end = (end[0] + in_dir[0] * ROUTE_STUB, end[1] + in_dir[1] * ROUTE_STUB)
+        margin = ROUTE_MARGIN
+        for _ in range(ROUTE_ATTEMPTS):
+            yield stub_start, stub_end, (min(stub_start[0], stub_end[0]) - margin, min(stub_start[1], stub_end[1]) - margin,
+                                         max(stub_start[0], stub_end[0]) + margin, max(stub_start[1], stub_end[1]) + margin)
+            margin *= 2
+
+    @staticmethod
+    def _window_cells(window, cell_size):
+        return ((window[2] - window[0]) // cell_size + 1) * ((window[3] - window[1]) // cell_size + 1)
+
+    @classmethod
+    def reach(cls, source_box, target_box, port_style, cell_size):
+        """
+        The rectangles route() can look at for an edge between two boxes: the
+        segments of its candidate paths and the search windows small enough to
+        be searched. A router over the boxes meeting these routes the edge as
+        one over every box would.
+        """
+        start, out_dir, end, in_dir = cls._ports(source_box, target_box, port_style)
+        rects = [(min(ax, bx), min(ay, by), max(ax, bx), max(ay, by))
+                 for path in cls._candidates(start, out_dir, end) for (ax, ay), (bx, by) in zip(path, path[1:])]
+        for _, _, window in cls._windows(start, out_dir, end, in_dir):
+            if cls._window_cells(window, max(float(cell_size), 1.0)) > ROUTE_MAX_WINDOW_CELLS:
+                break
+            rects.append(window)
+        return rects
+
+    def _clear(self, points, ignore):
+        for (ax, ay), (bx, by) in zip(points, points[1:]):
+            if self.grid.query_segment(ax, ay, bx, by, ignore, limit=1):
+                return False
+        return True
+
+    @staticmethod
+    def _leaves_outward(points, out_dir, in_dir):
+        """True when the first segment heads away from the source port and the last one into the target port."""
+        (ax, ay), (bx, by) = points[0], points[1]
+        (cx, cy), (dx, dy) = points[-2], points[-1]
+        return ((bx - ax) * out_dir[0] + (by - ay) * out_dir[1] > 0
+                and (cx - dx) * in_dir[0] + (cy - dy) * in_dir[1] > 0)
+
+    def route(self, source, target, port_style):
+        """Returns a list of (x, y) waypoints, [] when the default path is clear, or None when no route was found."""
+        if source not in self.boxes or target not in self.boxes or source == target:
+            return []
+        start, out_dir, end, in_dir = self._ports(self.boxes[source], self.boxes[target], port_style)
+        ignore = (source, target)
+
+        default, *corners = self._candidates(start, out_dir, end)
+        if self._clear(default, ignore):
+            return []
+
+        # Single-bend alternatives are cheap to check before searching
+        for candidate in corners:
+            if self._clear(candidate, ignore) and self._leaves_outward(candidate, out_dir, in_dir):
+                return _simplify(candidate)[1:-1]
+
+        for stub_start, stub_end, window in self._windows(start, out_dir, end, in_dir):
+            obstacles = self._window_obstacles(window, ignore)
+            if obstacles is None:
+                break
+            path = self._search(stub_start, stub_end, out_dir, (-in_dir[0], -in_dir[1]), window, obstacles)
+            if path is not None:
+                return _simplify([start] + path + [end])[1:-1]
+        return None
+
+    def _window_obstacles(self, window, endpoints):
+        """Boxes intersecting the search window, or None when the window is too large to search."""
+        if self._window_cells(window, self.grid.cell_size) > ROUTE_MAX_WINDOW_CELLS:
+            return None
+        found = set(self.grid.query(window)) | set(endpoints)
+        if len(found) > ROUTE_MAX_OBSTACLES:
+            return None
+        return [self.boxes[uid] for uid in found]
+
+    def _search(self, start, goal, start_dir, goal_dir, window, obstacles):
+        """A* over the orthogonal visibility grid of the padded obstacles inside `window`."""
+        pad = ROUTE_CLEARANCE
+        padded = [(x0 - pad, y0 - pad, x1 + pad, y1 + pad) for x0, y0, x1, y1 in obstacles]
+
+        xs = {start[0], goal[0], window[0], window[2]}
+        ys = {start[1], goal[1], window[1], window[3]}
+        for x0, y0, x1, y1 in padded:
+            xs.update(x for x in (x0, x1) if window[0] < x < window[2])
+            ys.update(y for y in (y0, y1) if window[1] < y < window[3])
+        xs, ys = sorted(xs), sorted(ys)
+
+        # Grid points strictly inside a padded box, and unit segments crossing one
+        inside, blocked_h, blocked_v = set(), set(), set()
+        for x0, y0, x1, y1 in padded:
+            inner_i = range(bisect_right(xs, x0), bisect_left(xs, x1))
+            inner_j = range(bisect_right(ys, y0), bisect_left(ys, y1))
+            for j in inner_j:
+                for i in range(bisect_left(xs, x0), bisect_right(xs, x1) - 1):
+                    blocked_h.add((i, j))
+            for i in inner_i:
+                for j in range(bisect_left(ys, y0), bisect_right(ys, y1) - 1):
+                    blocked_v.add((i, j))
+                for j in inner_j:
+                    inside.add((i, j))
+
+        start_node = (xs.index(start[0]), ys.index(start[1]))
+        goal_node = (xs.index(goal[0]), ys.index(goal[1]))
+        inside.discard(start_node)
+        inside.discard(goal_node)
+        gx, gy = goal
+        width, height = len(xs), len(ys)
+
+        def heuristic(i, j):
+            dx, dy = abs(xs[i] - gx), abs(ys[j] - gy)
+            # Not lined up with the goal means at least one more bend
+            return dx + dy + (ROUTE_BEND_PENALTY if dx and dy else 0)
+
+        # One state per grid point, remembering the direction it was reached in.
+        # Cheaper than (point, direction) states; bends are still penalised.
+        best = {start_node: 0.0}
+        arrived = {start_node: start_dir}
+        came_from = {}
+        closed = set()
+        h = heuristic(*start_node)
+        # Ties on f are broken towards the goal (smaller h) to avoid flooding plateaus
+        heap = [(h, h, 0.0, start_node)]
+        while heap:
+            _, _, cost, node = heapq.heappop(heap)
+            if node == goal_node:
+                path = [node]
+                while node in came_from:
+                    node = came_from[node]
+                    path.append(node)
+                return [(xs[i], ys[j]) for i, j in reversed(path)]
+            if node in closed:
+                continue
+            closed.add(node)
+            i, j = node
+            direction = arrived[node]
+            for step in _DIRECTIONS:
+                ni, nj = i + step[0], j + step[1]
+                if not (0 <= ni < width and 0 <= nj < height):
+                    continue
+                nxt = (ni, nj)
+                if nxt in closed or nxt in inside:
                     continue
+                if step[1] == 0:
+                    if (i if ni > i else ni, j) in blocked_h:
+                        continue
+                    new_cost = cost + abs(xs[ni] - xs[i])
+                else:
+                    if (i, j if nj > j else nj) in blocked_v:
+                        continue
+                    new_cost = cost + abs(ys[nj] - ys[j])
+                if step != direction:
+                    new_cost += ROUTE_BEND_PENALTY
+                if nxt == goal_node and step != goal_dir:
+                    new_cost += ROUTE_BEND_PENALTY
+                if new_cost < best.get(nxt, float('inf')):
+                    best[nxt] = new_cost
+                    arrived[nxt] = step
+                    came_from[nxt] = node
+                    h = heuristic(ni, nj)
+                    heapq.heappush(heap, (new_cost + h, h, new_cost, nxt))
+        return None
+
+EDGE_BASE_STYLE = "edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
+
+CELL_ID_DIGEST_SIZE = 8
+
+def _id_digest(key):
+    return hashlib.blake2b(str(key).encode('utf-8'), digest_size=CELL_ID_DIGEST_SIZE).hexdigest()
+
+def node_cell_id(user_id):
+    """
+    The draw.io cell id of a component: a hash of its user id, so the same spec
+    always produces the same ids and later patches can find the cell again.
+    """
+    return f"node-{_id_digest(user_id)}"
+
+def edge_key(edge):
+    """User-facing key of an edge: its 'id' when given, otherwise 'source->target'."""
+    if edge.get('id') is not None:
+        return str(edge['id'])
+    source = edge.get('source') or edge.get('source_id') or ""
+    target = edge.get('target') or edge.get('target_id') or ""
+    return f"{source}->{target}"
+
+def edge_cell_id(key):
+    return f"edge-{_id_digest(key)}"
+
+def _unique_cell_id(cell_id, used_ids):
+    """Suffixes repeated ids (duplicate user ids, parallel edges) so every cell stays unique."""
+    candidate, n = cell_id, 1
+    while candidate in used_ids:
+        n += 1
+        candidate = f"{cell_id}#{n}"
+    used_ids.add(candidate)
+    return candidate
+
+def _write_diagram(writer, components, edges, library, validate=True, auto_fix=False, route=True):
+    """
+    Emits all vertices and edges of one diagram through a DrawioWriter.
+    Returns (report, errors): the validate_layout() report, or None when validate
+    is False, and the spec errors from build_diagram_model(). Its blocked_edges
+    describe the edges as written: with route=True, an edge the router took
+    around its blockers is clear and one it found no way for is blocked, as in
+    patch_drawio_xml.
+    """
+    with tracing.span("diagram.parse", components=len(components), edges=len(edges)) as sp:
+        components, edges, errors = build_diagram_model(components, edges, library)
+        sp.set(errors=len(errors))
+    _report_errors(errors)
+
+    if not all(comp.positioned for comp in components):
+        with tracing.span("diagram.layout", components=len(components)):
+            layout_components(components, edges)
+        # Extra boundaries or titles are not placed by the layout; they go to the origin as before
+        for comp in components:
+            if not comp.positioned:
+                comp.x = comp.x or 0
+                comp.y = comp.y or 0
+    report = None
+    if validate or auto_fix:
+        with tracing.span("diagram.validate", fix=auto_fix) as sp:
+            report = validate_layout(components, edges, fix=auto_fix)
+            sp.set(**{name: len(found) for name, found in report.items()})
+
+    vertex_span = tracing.start_span("diagram.vertices")
+    by_id = {}
+    for comp in components:
+        by_id[comp.id] = comp
+        writer.vertex_xml(comp.cell_id, comp.label_xml, comp.style_xml, comp.x, comp.y, comp.width, comp.height)
+    vertex_span.end(vertices=writer.vertices)
+
+    router = None
+    if route and edges:
+        with tracing.span("diagram.route_index"):
+            boxes, roles, _ = _vertex_boxes(components)
+            router = EdgeRouter(boxes, [uid for uid in boxes if roles[uid] != 'boundary'])
+
+    edge_span = tracing.start_span("diagram.edges", routing=router is not None)
+    routed = 0
+    used_ids = set()
+    # validate_layout saw the edges before routing; only the ones written blocked stay reported
+    checked = {(found["source"], found["target"]): found for found in report["blocked_edges"]} if report else {}
+    blocked = []
+    for edge in edges:
+        source, target = by_id[edge.source], by_id[edge.target]
+        found = checked.get((edge.source, edge.target))
+        if edge.points:
+            # Drawn along the path the layout kept free for it, which validate_layout checked
+            points = edge.points
+            port_style = _waypoint_ports(source, points[0], target, points[-1])
+        else:
+            port_style = _port_style(source.x, source.y, target.x, target.y)
+            points = router.route(edge.source, edge.target, port_style) if router else None
+            if router and points is not None:
+                # Clear as written: the default path, or the router's way around the blockers
+                found = None
+            elif router:
+                found = found or {"source": edge.source, "target": edge.target, "blockers": []}
+        if found:
+            blocked.append(found)
+        routed += bool(points)
+        cell_id = _unique_cell_id(edge_cell_id(edge.key), used_ids)
+        writer.edge_xml(cell_id, edge.label_xml, EDGE_BASE_STYLE + port_style, source.cell_id, target.cell_id, points)
+    edge_span.end(edges=writer.edges, routed=routed)
+    if report is not None:
+        report["blocked_edges"] = blocked
+        _report_issues(report)
+    return report, errors
+
+def _report_errors(errors):
+    if errors:
+        sample = "; ".join(f"{e['kind']} {e['index']}: {e['error']}" for e in errors[:3])
+        print(f"Warning: {len(errors)} invalid spec item(s) skipped ({sample}{'; ...' if len(errors) > 3 else ''})")
 
-        if not isinstance(edge, dict):
-            print(f"Warning: Edge is not a dict: {edge}")
+FIRST_PAGE_ID = "demo-diagram"
+
+def _page_specs(components, edges, pages, errors):
+    """
+    Yields (name, components, edges) per page: the components/edges arguments
+    form the first page, followed by the `pages` entries. Lazy, so `pages` may be
+    a generator and only one page's spec needs to exist at a time.
+    """
+    number = 0
+    if components or edges or not pages:
+        number += 1
+        yield "Page-1", components or [], edges or []
+    for i, page in enumerate(pages or ()):
+        page = _parse_item(page)
+        if not isinstance(page, dict):
+            errors.append(_spec_error("page", i, "not a dict"))
             continue
+        number += 1
+        yield str(page.get("name") or f"Page-{number}"), page.get("components") or [], page.get("edges") or []
 
-        source_user_id = str(edge.get('source') or edge.get('source_id') or "")
-        target_user_id = str(edge.get('target') or edge.get('target_id') or "")
-        
-        source_id = node_id_map.get(source_user_id)
-        target_id = node_id_map.get(target_user_id)
-        
-        if source_id and target_id:
-            edge_id = f"edge-{uuid.uuid4()}"
-            value = edge.get('label', '')
-            # Escape XML entities in value
-            value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;").replace("'", "&apos;")
-            
-            # Dynamic Port Selection
-            style = "edgeStyle=orthogonalEdgeStyle;rounded=0;orthogonalLoop=1;jettySize=auto;html=1;"
-            
-            src_comp = comp_data_map.get(source_user_id)
-            tgt_comp = comp_data_map.get(target_user_id)
-            
-            if src_comp and tgt_comp:
-                try:
-                    sx, sy = float(src_comp.get('x', 0)), float(src_comp.get('y', 0))
-                    tx, ty = float(tgt_comp.get('x', 0)), float(tgt_comp.get('y', 0))
-                    
-                    dx = tx - sx
-                    dy = ty - sy
-                    
-                    # Logic: Determine primary direction
-                    if abs(dy) > abs(dx) and dy > 0:
-                        # Target is clearly BELOW Source
-                        # Exit Bottom (0.5, 1) -> Entry Top (0.5, 0)
-                        style += "exitX=0.5;exitY=1;entryX=0.5;entryY=0;"
-                    elif abs(dy) > abs(dx) and dy < 0:
-                         # Target is ABOVE Source
-                         style += "exitX=0.5;exitY=0;entryX=0.5;entryY=1;"
-                    elif dx > 0:
-                        # Target is RIGHT of Source
-                        style += "exitX=1;exitY=0.5;entryX=0;entryY=0.5;"
-                    else:
-                        # Target is LEFT of Source
-                        style += "exitX=0;exitY=0.5;entryX=1;entryY=0.5;"
-                except:
-                    # Fallback if coords are weird
-                    style += "exitX=1;exitY=0.5;entryX=0;entryY=0.5;"
-            else:
-                 # Fallback default
-                 style += "exitX=1;exitY=0.5;entryX=0;entryY=0.5;"
-
-            content_xml += f'<mxCell id="{edge_id}" value="{value}" style="{style}" edge="1" parent="1" source="{source_id}" target="{target_id}"><mxGeometry relative="1" as="geometry"/></mxCell>'
-            
-    raw_xml = xml_start + content_xml + xml_end
-    
-    # Pretty print
+def _write_pages(writer, pages, library, validate, auto_fix, route):
+    """Writes a whole document, one page at a time. Returns one summary dict per page."""
+    summaries = []
+    writer.start_file()
+    for n, (name, components, edges) in enumerate(pages):
+        vertices, edge_count = writer.vertices, writer.edges
+        with tracing.span("diagram.page", page=name):
+            writer.start_page(name, FIRST_PAGE_ID if n == 0 else f"page-{n + 1}")
+            report, errors = _write_diagram(writer, components, edges, library, validate, auto_fix, route)
+            writer.end_page()
+        summaries.append({"name": name, "vertices": writer.vertices - vertices, "edges": writer.edges - edge_count,
+                          "issues": report, "errors": errors})
+    writer.end_file()
+    return summaries
+
+def _merge_page_summaries(summaries, page_errors):
+    """Document-level issues and errors; with several pages each error names its page."""
+    if len(summaries) == 1:
+        return summaries[0]["issues"], page_errors + summaries[0]["errors"]
+    issues = None
+    if summaries and summaries[0]["issues"] is not None:
+        issues = {key: [found for page in summaries for found in page["issues"][key]] for key in summaries[0]["issues"]}
+    errors = page_errors + [{**error, "page": page["name"]} for page in summaries for error in page["errors"]]
+    return issues, errors
+
+def generate_drawio_xml(components, edges, filename_prefix="system_architecture", stream=False, indent=True, compressed=False, validate=True, auto_fix=False, route=True, skip_unchanged=True, pages=None):
+    """
+    Generates the Draw.io XML for a given list of components and edges.
+    Invalid items (unknown library ids, edges to missing components, ...) are
+    skipped; see build_diagram_model.
+    For multi-page documents pass `pages`, a list of {'name', 'components',
+    'edges'} dicts; the components/edges arguments, when not empty, are the
+    first page. Pages are laid out, validated and written one at a time.
+    With stream=True the cells are written straight to the output file and a
+    summary dict (path, vertex and edge counts, bytes, layout issues and spec
+    errors, plus per-page summaries for several pages) is returned instead of the XML.
+    With compressed=True the pages are stored deflated, as draw.io does by default.
+    The layout is checked for overlaps, boundary violations and blocked edges
+    (see validate_layout); auto_fix=True nudges components to resolve the first two.
+    With route=True, edges whose default path would cross a shape get explicit
+    waypoints around it (see EdgeRouter), and only the edges it finds no way for
+    are reported blocked.
+    Cell ids are derived from the user ids, so the same spec always produces the
+    same file; with skip_unchanged=True such a repeat returns the latest version's
+    path instead of writing a new version (see save_version).
+    """
+    tracing.debug(f"generate_drawio_xml called with prefix={filename_prefix}, {len(components or [])} components")
+    tracing.debug(lambda: f"Components dump: {json.dumps(components, default=str)}")
+    with tracing.span("generate", prefix=filename_prefix, stream=stream, compressed=compressed) as sp:
+        library = _library_store.by_id()
+        page_errors = []
+        page_specs = _page_specs(components, edges, pages, page_errors)
+
+        if stream:
+            def write(sink):
+                nonlocal writer, summaries
+                writer = DrawioWriter(sink, indent=indent, compressed=compressed)
+                summaries = _write_pages(writer, page_specs, library, validate, auto_fix, route)
+
+            writer = summaries = None
+            output_path, size, unchanged = save_version(filename_prefix, write, skip_unchanged)
+            sp.set(path=output_path, pages=len(summaries), vertices=writer.vertices, edges=writer.edges, bytes=size, unchanged=unchanged)
+            _report_errors(page_errors)
+            _report_saved(output_path, unchanged)
+            issues, errors = _merge_page_summaries(summaries, page_errors)
+            summary = {"path": output_path, "vertices": writer.vertices, "edges": writer.edges, "bytes": size,
+                       "issues": issues, "errors": errors, "unchanged": unchanged}
+            if len(summaries) > 1:
+                summary["pages"] = summaries
+            return summary
+
+        with tracing.span("xml.build"):
+            buf = io.StringIO()
+            writer = DrawioWriter(buf, indent=indent, compressed=compressed)
+            summaries = _write_pages(writer, page_specs, library, validate, auto_fix, route)
+            xml_text = buf.getvalue()
+        with tracing.span("file.write", bytes=len(xml_text)) as write_span:
+            output_path, size, unchanged = save_version(filename_prefix, lambda sink: sink.write(xml_text), skip_unchanged)
+            write_span.set(path=output_path, unchanged=unchanged)
+        sp.set(path=output_path, pages=len(summaries), vertices=writer.vertices, edges=writer.edges, bytes=size, unchanged=unchanged)
+        _report_errors(page_errors)
+        _report_saved(output_path, unchanged)
+        return xml_text
+
+def _report_saved(path, unchanged):
+    if unchanged:
+        print(f"Diagram unchanged, keeping {path}")
+    else:
+        print(f"Successfully saved diagram to {path}")
+
+
+_PORT_KEYS = ('exitX', 'exitY', 'entryX', 'entryY')
+# One start or end tag; quoted attribute values may contain '>'
+_XML_TAG_RE = re.compile(rb'<(?:[^"\'>]|"[^"]*"|\'[^\']*\')*>')
+_WRAPPER_TAGS = ('object', 'UserObject')
+# A vertex geometry as generate_drawio_xml and draw.io write it, x and y left out when 0
+_GEOMETRY_RE = re.compile(rb'<mxGeometry(?![^>]*relative="1")(?: x="([^"]*)")?(?: y="([^"]*)")?(?: width="([^"]*)")?(?: height="([^"]*)")?([^>]*)>')
+_GEOMETRY_ATTR_RE = re.compile(rb'([\w:.-]+)="([^"]*)"')
+_LEADING_TAG_RE = re.compile(rb'\s*<')
+
+def _with_port_style(style, port_style):
+    """Replaces the exit/entry keys of an edge style with a freshly chosen port style."""
+    kept = [part for part in (style or '').split(';') if part and part.split('=', 1)[0] not in _PORT_KEYS]
+    return ';'.join(kept) + ';' + port_style
+
+def _geometry_attrs(x, y, width, height):
+    return {'x': _coord(x), 'y': _coord(y), 'width': _coord(width), 'height': _coord(height), 'as': 'geometry'}
+
+def _set_edge_points(cell, points):
+    for geo in cell.findall('mxGeometry'):
+        cell.remove(geo)
+    geo = ET.SubElement(cell, 'mxGeometry', {'relative': '1', 'as': 'geometry'})
+    if points:
+        array = ET.SubElement(geo, 'Array', {'as': 'points'})
+        for x, y in points:
+            ET.SubElement(array, 'mxPoint', {'x': _coord(x), 'y': _coord(y)})
+
+class _CellRecord:
+    """Where a top-level cell sits in the document, with the attributes needed to patch around it."""
+    __slots__ = ("attrs", "geometry", "start", "end")
+
+    def __init__(self, attrs, geometry=None, start=None, end=None):
+        self.attrs = attrs
+        self.geometry = geometry
+        self.start = start
+        self.end = end
+
+def _escaped_forms(value):
+    """The ways an attribute value can appear in a file: as generate_drawio_xml and as ElementTree escape it."""
+    return {xml_attr(value).encode('utf-8'),
+            html.escape(value, quote=False).replace('"', '&quot;').encode('utf-8')}
+
+class _PatchDocument:
+    """
+    An existing draw.io file opened for patching.
+    Nothing is parsed up front: cells are found by searching the bytes of the
+    page for their id, or for the source/target attributes that name a vertex,
+    and only the cells found are parsed. Vertex geometry is read in a single
+    regex pass, and only when a router or an overlap check needs the boxes
+    around a change (see vertex_boxes). Changed cells are re-serialized
+    individually; everything else is copied through byte for byte when the new
+    version is written. Compressed pages are inflated first and deflated again
+    on write. Only one page is patched: the first, or the one selected by name
+    or zero-based index.
+    """
+    def __init__(self, path, page=None):
+        with open(path, 'rb') as f:
+            self.outer = f.read()
+        self.page = page
+        self.diagram_range = None
+        self.data = self.outer
+        lo, hi = self._select_page(path)
+        root = self.data.find(b'<root', lo, hi)
+        self.root_end = self.data.rfind(b'</root>', lo, hi)
+        if root < 0 or self.root_end < 0:
+            raise ValueError(f"{path} has no graph model")
+        self.root_start = _XML_TAG_RE.match(self.data, root).end()
+        self.cells = {}
+        self._missing = set()
+        self.changed = {}
+        self.removed = set()
+        self.added = []
+        self._edges_by_terminal = {}
+
+    def _selects(self, attrs, index):
+        if self.page is None:
+            return index == 0
+        if isinstance(self.page, int):
+            return index == self.page
+        return (attrs.get('name') or f"Page-{index + 1}") == self.page
+
+    def _select_page(self, path):
+        """Finds the selected <diagram>, inflating it when compressed. Returns the byte range of its model in self.data."""
+        outer = self.outer
+        found = False
+        for index, match in enumerate(re.finditer(rb'<diagram\b', outer)):
+            found = True
+            tag = _XML_TAG_RE.match(outer, match.start())
+            if not self._selects(ET.fromstring(tag.group().rstrip(b'/>') + b'/>').attrib, index):
+                continue
+            start, end = tag.end(), outer.find(b'</diagram>', tag.end())
+            if end < 0:
+                break
+            if _LEADING_TAG_RE.match(outer, start):
+                return start, end
+            self.diagram_range = (start, end)
+            self.data = decode_diagram(outer[start:end].decode('ascii')).encode('utf-8')
+            return 0, len(self.data)
+        if found:
+            raise ValueError(f"{path} has no <diagram> page" + ("" if self.page is None else f" {self.page!r}"))
+        # A bare <mxGraphModel> file
+        return 0, len(outer)
+
+    def _cell_start(self, tag_start):
+        """The start of the top-level cell whose own tag, or wrapped <mxCell>, starts at tag_start."""
+        data = self.data
+        if data.startswith(b'<mxCell', tag_start):
+            previous = data.rfind(b'<', self.root_start, tag_start)
+            if previous >= 0 and data[previous + 1:previous + 2] != b'/':
+                tag = _XML_TAG_RE.match(data, previous)
+                name = tag.group()[1:].split(None, 1)[0].rstrip(b'/>').decode('ascii', 'replace')
+                if name in _WRAPPER_TAGS and not data[tag.end():tag_start].strip() and not tag.group().endswith(b'/>'):
+                    return previous
+        return tag_start
+
+    def _cell_end(self, start):
+        data = self.data
+        tag = _XML_TAG_RE.match(data, start)
+        if tag.group().endswith(b'/>'):
+            return tag.end()
+        name = tag.group()[1:].split(None, 1)[0].rstrip(b'>')
+        return data.index(b'</' + name + b'>', tag.end()) + len(name) + 3
+
+    def _record_at(self, start):
+        """Parses the top-level cell starting at `start` and caches its record under its id."""
+        end = self._cell_end(start)
+        elem = ET.fromstring(self.data[start:end])
+        cell = elem if elem.tag == 'mxCell' else elem.find('mxCell')
+        attrs = dict(elem.attrib) if cell is None or cell is elem else {**cell.attrib, **elem.attrib}
+        geometry = None
+        for geo in (cell if cell is not None else elem).iter('mxGeometry'):
+            if geo.get('as') == 'geometry':
+                geometry = dict(geo.attrib)
+                break
+        cell_id = attrs.get('id')
+        record = _CellRecord(attrs, geometry, start, end)
+        if cell_id is not None:
+            record = self.cells.setdefault(cell_id, record)
+            self._missing.discard(cell_id)
+        return record
+
+    def record(self, cell_id):
+        """The record of a cell by id, or None when there is no such cell on the page."""
+        record = self.cells.get(cell_id)
+        if record is not None or cell_id in self._missing:
+            return record
+        data = self.data
+        for needle in _escaped_forms(cell_id):
+            needle = b'id="' + needle + b'"'
+            position = data.find(needle, self.root_start, self.root_end)
+            while position >= 0:
+                if data[position - 1:position].isspace():
+                    tag_start = data.rfind(b'<', self.root_start, position)
+                    name = data[tag_start + 1:position].split(None, 1)[0].decode('ascii', 'replace')
+                    if name == 'mxCell' or name in _WRAPPER_TAGS:
+                        record = self._record_at(self._cell_start(tag_start))
+                        if record.attrs.get('id') == cell_id:
+                            return record
+                position = data.find(needle, position + 1, self.root_end)
+        self._missing.add(cell_id)
+        return None
+
+    def find_vertex(self, user_id):
+        """A vertex by user id (cells written by generate_drawio_xml), or by its raw cell id."""
+        user_id = str(user_id)
+        for cell_id in (node_cell_id(user_id), user_id):
+            record = self.record(cell_id)
+            if record is not None and record.attrs.get('vertex') == '1':
+                return cell_id
+        return None
+
+    def find_edge(self, ref):
+        """An edge by key or raw cell id, or by a {'source', 'target'} dict of user ids."""
+        key = edge_key(ref) if isinstance(ref, dict) else str(ref)
+        for cell_id in (edge_cell_id(key), key):
+            record = self.record(cell_id)
+            if record is not None and record.attrs.get('edge') == '1':
+                return cell_id
+        if not isinstance(ref, dict):
+            return None
+        # Files from older versions have random edge ids; match on the endpoints
+        source = self.find_vertex(ref.get('source') or ref.get('source_id') or "")
+        target = self.find_vertex(ref.get('target') or ref.get('target_id') or "")
+        if source is None or target is None:
+            return None
+        for cell_id in self.edges_of(source):
+            if self.cells[cell_id].attrs.get('target') == target:
+                return cell_id
+        return None
+
+    def edges_of(self, vertex_id):
+        """Ids of the edges with vertex_id as source or target, added ones included."""
+        found = self._edges_by_terminal.get(vertex_id)
+        if found is None:
+            found = []
+            data = self.data
+            for needle in _escaped_forms(vertex_id):
+                for key in (b'source="', b'target="'):
+                    needle_key = key + needle + b'"'
+                    position = data.find(needle_key, self.root_start, self.root_end)
+                    while position >= 0:
+                        if data[position - 1:position].isspace():
+                            record = self._record_at(self._cell_start(data.rfind(b'<', self.root_start, position)))
+                            cell_id = record.attrs.get('id')
+                            if record.attrs.get('edge') == '1' and cell_id not in found:
+                                found.append(cell_id)
+                        position = data.find(needle_key, position + 1, self.root_end)
+            self._edges_by_terminal[vertex_id] = found
+        added = [cell_id for cell_id in self.added if vertex_id in
+                 (self.cells[cell_id].attrs.get('source'), self.cells[cell_id].attrs.get('target'))
+                 and self.cells[cell_id].attrs.get('edge') == '1']
+        return found + [cell_id for cell_id in added if cell_id not in found]
+
+    def element(self, cell_id):
+        """The cell as an Element to modify; it is written back in place of the original."""
+        elem = self.changed.get(cell_id)
+        if elem is None:
+            record = self.cells[cell_id]
+            elem = self.changed[cell_id] = ET.fromstring(self.data[record.start:record.end])
+        return elem
+
+    def add(self, elem):
+        cell_id = elem.get('id')
+        geo = elem.find('mxGeometry')
+        self.cells[cell_id] = _CellRecord(dict(elem.attrib), dict(geo.attrib) if geo is not None else None)
+        self._missing.discard(cell_id)
+        self.changed[cell_id] = elem
+        self.added.append(cell_id)
+
+    def remove(self, cell_ids):
+        self.removed.update(cell_ids)
+
+    @staticmethod
+    def box(record):
+        """A vertex record's (x0, y0, x1, y1), or None when it has no usable geometry."""
+        geo = record.geometry
+        if geo is None or record.attrs.get('vertex') != '1':
+            return None
+        try:
+            x, y = float(geo.get('x', 0)), float(geo.get('y', 0))
+            return (x, y, x + float(geo.get('width', 0)), y + float(geo.get('height', 0)))
+        except ValueError:
+            return None
+
+    def _stored_boxes(self, regions=None, cell_size=None):
+        """
+        (position, box) for each vertex geometry stored in the page, skipping the
+        changed and removed cells; with regions given, only the boxes meeting one.
+        One regex pass, with no per-cell parsing. Boxes no larger than cell_size
+        are first looked up in a set of the grid cells the regions cover.
+        """
+        data = self.data
+        skip = sorted((record.start, record.end) for cell_id in self.removed.union(self.changed)
+                      for record in (self.cells[cell_id],) if record.start is not None)
+        skip_starts = [start for start, _ in skip]
+        if regions is not None:
+            if not regions:
+                return
+            size = max(float(cell_size), 1.0)
+            # Keyed by the cell of a box's top-left corner: a box of up to one cell
+            # meets a region only if that cell or its right/lower neighbours do
+            covered = set()
+            for x0, y0, x1, y1 in regions:
+                for cx in range(int(x0 // size) - 1, int(x1 // size) + 1):
+                    for cy in range(int(y0 // size) - 1, int(y1 // size) + 1):
+                        covered.add((cx, cy))
+        for match in _GEOMETRY_RE.finditer(data, self.root_start, self.root_end):
+            x, y, width, height, rest = match.groups()
+            if rest.strip(b' /') != b'as="geometry"':
+                # Attributes in another order, or some other geometry
+                attrs = dict(_GEOMETRY_ATTR_RE.findall(match.group()))
+                if attrs.get(b'as') != b'geometry':
+                    continue
+                x, y, width, height = (attrs.get(key) for key in (b'x', b'y', b'width', b'height'))
+            try:
+                x0, y0 = float(x or 0), float(y or 0)
+                x1, y1 = x0 + float(width or 0), y0 + float(height or 0)
+            except ValueError:
+                continue
+            box = (x0, y0, x1, y1)
+            if regions is not None:
+                if x1 - x0 <= size and y1 - y0 <= size and (int(x0 // size), int(y0 // size)) not in covered:
+                    continue
+                if not any(_rects_overlap(box, region) for region in regions):
+                    continue
+            position = match.start()
+            i = bisect_right(skip_starts, position) - 1
+            if i >= 0 and position < skip[i][1]:
+                continue
+            yield position, box
+
+    def _changed_boxes(self):
+        for cell_id in self.changed:
+            box = self.box(self.cells[cell_id])
+            if box is not None and cell_id not in self.removed:
+                yield cell_id, box
+
+    def right_edge(self):
+        """The largest x1 of the remaining vertices, or None for an empty page."""
+        edges = [box[2] for _, box in self._stored_boxes()]
+        edges.extend(box[2] for _, box in self._changed_boxes())
+        return max(edges, default=None)
+
+    def vertex_boxes(self, regions, cell_size):
+        """
+        ({cell_id: (x0, y0, x1, y1)}, {cell_id: role}) for the remaining vertices
+        whose boxes meet one of `regions`; changed and added cells count with their
+        new geometry. Only the vertices that qualify are looked up and parsed.
+        """
+        regions = [(x0 - 1, y0 - 1, x1 + 1, y1 + 1) for x0, y0, x1, y1 in regions]
+        boxes, roles = {}, {}
+        data = self.data
+        for position, box in self._stored_boxes(regions, cell_size):
+            record = self._record_at(self._cell_start(data.rfind(b'<mxCell', self.root_start, position)))
+            if record.attrs.get('vertex') == '1':
+                boxes[record.attrs.get('id')] = box
+        for cell_id, box in self._changed_boxes():
+            if any(_rects_overlap(box, region) for region in regions):
+                boxes[cell_id] = box
+        role_of_style = {}
+        for cell_id in boxes:
+            style = self.cells[cell_id].attrs.get('style', '')
+            role = role_of_style.get(style)
+            if role is None:
+                role = role_of_style[style] = component_role(style)
+            roles[cell_id] = role
+        return boxes, roles
+
+    def _indent_before(self, position):
+        """Whitespace between the previous line break and `position`; empty for unindented files."""
+        line_start = self.data.rfind(b'\n', 0, position) + 1
+        prefix = self.data[line_start:position]
+        return prefix.decode('ascii') if line_start and not prefix.strip() else ''
+
+    def _serialize(self, elem, indent):
+        for node in elem.iter():
+            if node.text is not None and not node.text.strip():
+                node.text = None
+            node.tail = None
+        if indent:
+            unit = '\t' if '\t' in indent else '  '
+            ET.indent(elem, space=unit, level=len(indent) // len(unit))
+            elem.tail = None
+        # ElementTree writes '<a />'; match the '<a/>' of the original cells
+        return ET.tostring(elem, encoding='unicode').replace(' />', '/>').encode('utf-8')
+
+    def _model_chunks(self):
+        """The new graph model as a sequence of byte chunks."""
+        data = self.data
+        edits = []
+        for cell_id in self.removed:
+            record = self.cells[cell_id]
+            if record.start is None:
+                continue
+            start = record.start
+            # Take the indentation in front of the cell along with it
+            while start and data[start - 1] in b' \t\r\n':
+                start -= 1
+            edits.append((start, record.end, b''))
+        for cell_id, elem in self.changed.items():
+            record = self.cells[cell_id]
+            if record.start is None or cell_id in self.removed:
+                continue
+            edits.append((record.start, record.end, self._serialize(elem, self._indent_before(record.start))))
+
+        added = [cell_id for cell_id in self.added if cell_id not in self.removed]
+        if added:
+            insert_at = self.root_end
+            while insert_at and data[insert_at - 1] in b' \t\r\n':
+                insert_at -= 1
+            last = data.rfind(b'<mxCell', self.root_start, self.root_end)
+            indent = self._indent_before(self._cell_start(last)) if last >= 0 else ''
+            newline = b'\n' if indent else b''
+            text = b''.join(newline + indent.encode('ascii') + self._serialize(self.changed[cell_id], indent)
+                            for cell_id in added)
+            edits.append((insert_at, insert_at, text))
+
+        view = memoryview(data)
+        position = 0
+        for start, end, replacement in sorted(edits, key=lambda e: (e[0], e[1])):
+            yield view[position:start]
+            yield replacement
+            position = end
+        yield view[position:]
+
+    def write(self, f):
+        """Writes the patched document to a binary file."""
+        if self.data is self.outer:
+            for chunk in self._model_chunks():
+                f.write(chunk)
+            return
+        start, end = self.diagram_range
+        buf = io.StringIO()
+        stream = DeflateStream(buf)
+        stream.write(b''.join(self._model_chunks()).decode('utf-8'))
+        stream.close()
+        f.write(self.outer[:start])
+        f.write(buf.getvalue().encode('ascii'))
+        f.write(self.outer[end:])
+
+class _DocumentIds:
+    """The cell ids of a patched page plus the ones handed out since, as the used_ids of _unique_cell_id."""
+    def __init__(self, doc):
+        self.doc = doc
+        self.taken = set()
+
+    def __contains__(self, cell_id):
+        return cell_id in self.taken or self.doc.record(cell_id) is not None
+
+    def add(self, cell_id):
+        self.taken.add(cell_id)
+
+def _patch_prefix(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return re.sub(r'_v\d+$', '', stem)
+
+def patch_drawio_xml(path, add_components=None, update_components=None, remove_components=None,
+                     add_edges=None, update_edges=None, remove_edges=None,
+                     filename_prefix=None, validate=True, route=True, skip_unchanged=True, page=None):
+    """
+    Applies a delta to an existing .drawio file and saves it as the next version.
+    Multi-page files are patched one page at a time: the first page, or the one
+    named by `page` (a page name or zero-based index); other pages are kept as is.
+    Components and edges are addressed by the user ids they were generated with
+    (edges by their 'id' or by 'source'/'target'); raw cell ids work as well.
+      - add_components / add_edges: specs as for generate_drawio_xml. Components
+        without x/y are stacked in a column right of the existing diagram.
+      - update_components: dicts with 'id' and any of label, library_id, x, y, width, height.
+      - update_edges: dicts identifying an edge plus a new 'label'.
+      - remove_components: ids; their connected edges are removed too.
+      - remove_edges: edge ids or {'source', 'target'} dicts.
+    Untouched cells are copied through byte for byte, ids included. Ports are
+    re-chosen, and edges re-routed, only for edges that were added or touch a
+    changed vertex, and only changed vertices are checked for overlaps. Cells are
+    found by searching the file rather than parsing it: only the addressed cells
+    are parsed, and only vertices near the change or the rerouted edges' paths
+    are indexed, so the cost follows the delta rather than the diagram.
+    As with generate_drawio_xml, a result identical to the latest version is not
+    written again (skip_unchanged).
+    Returns a summary dict: path, base, added, updated, removed, bytes, issues, errors, unchanged.
+    """
+    tracing.debug(f"patch_drawio_xml called on {path}")
+    with tracing.span("patch", base=path) as sp:
+        library = _library_store.by_id()
+        with tracing.span("patch.parse"):
+            doc = _PatchDocument(path, page)
+        used_ids = _DocumentIds(doc)
+        removed, touched, reroute = set(), set(), set()
+        counts = {"added": 0, "updated": 0, "removed": 0}
+        errors = []
+
+        def items(specs, kind):
+            for spec in specs or ():
+                spec = _parse_item(spec)
+                if isinstance(spec, dict):
+                    yield spec
+                else:
+                    errors.append(f"{kind} is not a dict: {spec}")
+
+        for user_id in remove_components or ():
+            cell_id = doc.find_vertex(user_id)
+            if cell_id is None:
+                errors.append(f"remove: no component {user_id}")
+                continue
+            removed.add(cell_id)
+            removed.update(doc.edges_of(cell_id))
+        for ref in remove_edges or ():
+            cell_id = doc.find_edge(ref)
+            if cell_id is None:
+                errors.append(f"remove: no edge {ref}")
+                continue
+            removed.add(cell_id)
+
+        for comp in items(update_components, "component"):
+            cell_id = doc.find_vertex(comp.get('id', ''))
+            if cell_id is None or cell_id in removed:
+                errors.append(f"update: no component {comp.get('id')}")
+                continue
+            try:
+                geometry = {key: _coord(_number(comp[key])) for key in ('x', 'y', 'width', 'height') if comp.get(key) is not None}
+            except (TypeError, ValueError):
+                errors.append(f"update: geometry of {comp.get('id')} is not numeric")
+                continue
+            elem = doc.element(cell_id)
+            cell = elem if elem.tag == 'mxCell' else elem.find('mxCell')
+            if 'label' in comp:
+                elem.set('value' if elem.tag == 'mxCell' else 'label', str(comp['label']))
+            lib_item = library.get(comp.get('library_id'))
+            if lib_item:
+                cell.set('style', lib_item['style'])
+                doc.cells[cell_id].attrs['style'] = lib_item['style']
+            if geometry:
+                geo = cell.find('mxGeometry')
+                if geo is None:
+                    geo = ET.SubElement(cell, 'mxGeometry', {'as': 'geometry'})
+                for key, value in geometry.items():
+                    geo.set(key, value)
+                doc.cells[cell_id].geometry = dict(geo.attrib)
+                touched.add(cell_id)
+            counts["updated"] += 1
+
+        next_x = next_y = None
+        for comp in items(add_components, "component"):
+            user_id = str(comp.get('id', ''))
+            lib_item = library.get(comp.get('library_id'))
+            if not user_id or not lib_item:
+                errors.append(f"add: component needs an id and a known library_id: {comp}")
+                continue
+            if doc.find_vertex(user_id) is not None:
+                errors.append(f"add: component {user_id} already exists")
+                continue
+            try:
+                width = _number(comp.get('width', lib_item['width']))
+                height = _number(comp.get('height', lib_item['height']))
+                x, y = _number(comp.get('x')), _number(comp.get('y'))
+            except (TypeError, ValueError):
+                errors.append(f"add: geometry of {user_id} is not numeric")
+                continue
+            if x is None or y is None:
+                if next_x is None:
+                    right = doc.right_edge()
+                    next_x = (LAYOUT_ORIGIN[0] if right is None else right) + LAYOUT_COLUMN_GAP
+                    next_y = LAYOUT_ORIGIN[1]
+                x, y = next_x, next_y
+                next_y += float(height) + LAYOUT_STACK_GAP
+            cell = ET.Element('mxCell', {
+                'id': _unique_cell_id(node_cell_id(user_id), used_ids),
+                'value': str(comp.get('label', lib_item['value'])),
+                'style': lib_item['style'],
+                'vertex': '1',
+                'parent': '1',
+            })
+            ET.SubElement(cell, 'mxGeometry', _geometry_attrs(x, y, width, height))
+            doc.add(cell)
+            touched.add(cell.get('id'))
+            counts["added"] += 1
+
+        for edge in items(update_edges, "edge"):
+            cell_id = doc.find_edge(edge)
+            if cell_id is None or cell_id in removed:
+                errors.append(f"update: no edge {edge_key(edge)}")
+                continue
+            if 'label' in edge:
+                elem = doc.element(cell_id)
+                elem.set('value' if elem.tag == 'mxCell' else 'label', str(edge['label']))
+            counts["updated"] += 1
+
+        for edge in items(add_edges, "edge"):
+            source = doc.find_vertex(edge.get('source') or edge.get('source_id') or "")
+            target = doc.find_vertex(edge.get('target') or edge.get('target_id') or "")
+            if source is None or target is None or {source, target} & removed:
+                errors.append(f"add: edge {edge_key(edge)} has an unknown endpoint")
+                continue
+            cell = ET.Element('mxCell', {
+                'id': _unique_cell_id(edge_cell_id(edge_key(edge)), used_ids),
+                'value': str(edge.get('label', '')),
+                'style': EDGE_BASE_STYLE,
+                'edge': '1',
+                'parent': '1',
+                'source': source,
+                'target': target,
+            })
+            _set_edge_points(cell, None)
+            doc.add(cell)
+            reroute.add(cell.get('id'))
+            counts["added"] += 1
+
+        for vertex_id in touched:
+            reroute.update(doc.edges_of(vertex_id))
+        reroute -= removed
+        counts["removed"] = len(removed)
+        doc.remove(removed)
+
+        report = {"overlaps": [], "outside_boundary": [], "blocked_edges": []} if validate else None
+        router = None
+        boxes, ports = {}, {}
+        if touched or reroute:
+            # Only the boxes around the change are read: the touched vertices and
+            # whatever the rerouted edges' candidate paths and search windows reach
+            with tracing.span("patch.index") as index_span:
+                known = {}
+                for cell_id in touched:
+                    known[cell_id] = doc.box(doc.cells[cell_id])
+                for cell_id in reroute:
+                    attrs = doc.cells[cell_id].attrs
+                    for end in (attrs.get('source'), attrs.get('target')):
+                        if end and end not in known and end not in removed:
+                            record = doc.record(end)
+                            known[end] = doc.box(record) if record is not None else None
+                known = {cell_id: box for cell_id, box in known.items() if box is not None}
+                cell_size = _grid_cell_size(known)
+                regions = [known[cell_id] for cell_id in touched if cell_id in known]
+                for cell_id in reroute:
+                    attrs = doc.cells[cell_id].attrs
+                    source, target = attrs.get('source'), attrs.get('target')
+                    if source in known and target in known:
+                        sbox, tbox = known[source], known[target]
+                        ports[cell_id] = _port_style(sbox[0], sbox[1], tbox[0], tbox[1])
+                        if route:
+                            regions.extend(EdgeRouter.reach(sbox, tbox, ports[cell_id], cell_size))
+                boxes, roles = doc.vertex_boxes(regions, cell_size)
+                boxes.update(known)
+                for cell_id in known.keys() - roles.keys():
+                    roles[cell_id] = component_role(doc.cells[cell_id].attrs.get('style', ''))
+                index_span.set(regions=len(regions), vertices=len(boxes))
+            if route and ports:
+                router = EdgeRouter(boxes, [cid for cid in boxes if roles[cid] != 'boundary'], cell_size)
+        if validate and touched:
+            with tracing.span("patch.validate", vertices=len(touched)):
+                if router:
+                    grid = router.grid
+                else:
+                    grid = SpatialGrid(cell_size)
+                    for cell_id, box in boxes.items():
+                        if roles[cell_id] != 'boundary':
+                            grid.insert(cell_id, box)
+                boundary = next((b for cid, b in boxes.items() if roles[cid] == 'boundary'), None)
+                overlaps = set()
+                for cell_id in sorted(touched):
+                    if roles.get(cell_id, 'boundary') == 'boundary':
+                        continue
+                    overlaps.update(tuple(sorted((hit, cell_id))) for hit in grid.query(boxes[cell_id]) if hit != cell_id)
+                    if boundary and roles[cell_id] not in ('actor', 'title') and _crosses_boundary(boundary, boxes[cell_id]):
+                        report["outside_boundary"].append(cell_id)
+                report["overlaps"] = sorted(overlaps)
+
+        with tracing.span("patch.edges", edges=len(reroute), routing=router is not None):
+            for cell_id in sorted(reroute):
+                if cell_id not in ports:
+                    continue
+                attrs = doc.cells[cell_id].attrs
+                source, target = attrs.get('source'), attrs.get('target')
+                port_style = ports[cell_id]
+                points = router.route(source, target, port_style) if router else None
+                if points is None and router and report is not None:
+                    report["blocked_edges"].append({"source": source, "target": target, "blockers": []})
+                elem = doc.element(cell_id)
+                cell = elem if elem.tag == 'mxCell' else elem.find('mxCell')
+                cell.set('style', _with_port_style(cell.get('style'), port_style))
+                _set_edge_points(cell, points)
+        if report is not None:
+            _report_issues(report)
+        for error in errors:
+            print(f"Warning: {error}")
+
+        with tracing.span("file.write") as write_span:
+            output_path, size, unchanged = save_version(filename_prefix or _patch_prefix(path), doc.write, skip_unchanged)
+            write_span.set(path=output_path, unchanged=unchanged)
+        sp.set(path=output_path, bytes=size, unchanged=unchanged, **counts)
+        _report_saved(output_path, unchanged)
+        return {"path": output_path, "base": path, **counts, "bytes": size, "issues": report,
+                "errors": errors, "unchanged": unchanged}
+
+import time
+
+def _warm_library():
+    _library_store.items()
+
+def _generate_spec(indexed_spec):
+    """Generates one batch spec and returns its result record. Never raises."""
+    index, spec = indexed_spec
+    started = time.perf_counter()
+    result = {"index": index, "path": None, "seconds": 0.0, "error": None}
     try:
-        dom = xml.dom.minidom.parseString(raw_xml)
-        pretty_xml = dom.toprettyxml()
-        
-        # Save to file
-        output_path = get_next_version_filename(filename_prefix)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(pretty_xml)
-        print(f"Successfully saved diagram to {output_path}")
-        
-        return pretty_xml
+        if isinstance(spec, str):
+            spec = json.loads(spec)
+        summary = generate_drawio_xml(
+            spec.get("components", []),
+            spec.get("edges", []),
+            filename_prefix=spec.get("filename_prefix", "system_architecture"),
+            stream=True,
+            indent=spec.get("indent", True),
+            compressed=spec.get("compressed", False),
+            auto_fix=spec.get("auto_fix", False),
+            pages=spec.get("pages"),
+        )
+        result.update(summary)
     except Exception as e:
-        print(f"Error pretty printing/saving XML: {e}")
-        return raw_xml
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    return result
+
+def generate_drawio_batch(specs, workers=1):
+    """
+    Generates many diagrams without the model in the loop.
+    Each spec is a dict with 'components', 'edges' and optionally
+    'filename_prefix', 'indent', 'compressed' and 'pages'. With workers > 1
+    the specs are spread over a process pool; the library is loaded once per worker.
+    Returns one record per spec, in input order, with the output path, vertex
+    and edge counts, bytes, seconds and error (None on success).
+    """
+    specs = list(specs)
+    # Loaded here first so forked workers inherit a warm LibraryStore
+    _warm_library()
+    if workers <= 1 or len(specs) <= 1:
+        return [_generate_spec(item) for item in enumerate(specs)]
+    # Imported here: it pulls in multiprocessing and logging, which single calls never need
+    from concurrent.futures import ProcessPoolExecutor
+    chunksize = max(1, len(specs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_warm_library) as pool:
+        return list(pool.map(_generate_spec, enumerate(specs), chunksize=chunksize))
+
+def _read_specs(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Generates diagrams from a JSONL file of component/edge specs.")
+    parser.add_argument('specs', help="JSONL file, one {components, edges, filename_prefix} object per line")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-o', '--output', help="write per-spec results as JSONL here (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output:
+        out = open(args.output, 'w', encoding='utf-8')
+    else:
+        # stdout carries only the JSONL results: per-diagram messages, from this
+        # process and from the workers, which inherit the descriptor, go to stderr
+        sys.stdout.flush()
+        out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    started = time.perf_counter()
+    results = generate_drawio_batch(_read_specs(args.specs), workers=args.workers)
+    elapsed = time.perf_counter() - started
+    with out:
+        out.writelines(json.dumps(r) + "\n" for r in results)
+    failed = sum(1 for r in results if r["error"])
+    print(f"Generated {len(results) - failed}/{len(results)} diagrams in {elapsed:.2f}s ({failed} failed)", file=sys.stderr)
@@ -0,0 +1,133 @@
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+TRACE_ENV = "DIAGRAM_TRACE"
+DEBUG_ENV = "DIAGRAM_DEBUG"
+
+_exporter = None
+_debug = os.environ.get(DEBUG_ENV, "") not in ("", "0")
+_span_ids = itertools.count(1)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """
+    One timed operation. Use it as a context manager, or call end() when it
+    was started with start_span(). Attributes (sizes, counts, paths) can be
+    added with set() at any point before the span ends.
+    """
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "started_at", "_started", "_token")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        # pid-qualified so spans from worker processes can point at a parent in the main process
+        self.span_id = f"{os.getpid()}-{next(_span_ids)}"
+        self.parent_id = _current_span.get()
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, **attrs):
+        self.attrs.update(attrs)
+        exporter = _exporter
+        if exporter is None:
+            return
+        exporter({
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.started_at,
+            "seconds": round(time.perf_counter() - self._started, 6),
+            "pid": os.getpid(),
+            **self.attrs,
+        })
+
+    def __enter__(self):
+        self._token = _current_span.set(self.span_id)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+class _NoopSpan:
+    """Returned while tracing is off so instrumented code costs one function call."""
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def end(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = _NoopSpan()
+
+def span(name, **attrs):
+    """Context manager timing a block; nested spans record their parent."""
+    if _exporter is None:
+        return NOOP_SPAN
+    return Span(name, attrs)
+
+def start_span(name, **attrs):
+    """Starts a span that is ended explicitly with .end(), e.g. across callbacks."""
+    return span(name, **attrs)
+
+def enabled():
+    return _exporter is not None
+
+class JsonlExporter:
+    """Appends one JSON object per span to a file. Safe to share between threads and forked workers."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+def configure(path=None, exporter=None):
+    """
+    Turns tracing on with a JSONL file or any callable taking a span record dict.
+    configure() with neither turns it off again.
+    """
+    global _exporter
+    if exporter is None and path:
+        exporter = JsonlExporter(path)
+    _exporter = exporter
+    return exporter
+
+def set_debug(value):
+    global _debug
+    _debug = bool(value)
+
+def debug_enabled():
+    return _debug
+
+def debug(message):
+    """Prints a DEBUG line when DIAGRAM_DEBUG is set. Pass a callable to defer building expensive messages."""
+    if _debug:
+        print(f"DEBUG: {message() if callable(message) else message}")
+
+if os.environ.get(TRACE_ENV):
+    configure(path=os.environ[TRACE_ENV])